@@ -0,0 +1,65 @@
+import asyncio
+import time
+import config
+from key_pool import key_pool
+from utils import check_and_remove_key
+
+
+class BalanceTracker:
+    """按估算费用在内存中扣减key余额，只在必要时才向上游核实
+
+    每次调用按价格表估算费用并从内存余额中扣除；只有在估算余额跌破阈值、
+    转发出错或距离上次核实超过最小间隔时，才调用 /v1/user/info 核实。
+    同一个key的并发核实请求会合并为一次。
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    @staticmethod
+    def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int):
+        """按价格表估算一次调用的费用（价格单位：元/百万token，元/次）"""
+        prices = config.MODEL_PRICES.get(model)
+        if prices is None:
+            prices = config.MODEL_PRICES.get("default", {})
+        return (
+            (prompt_tokens or 0) * prices.get("input", 0) / 1_000_000
+            + (completion_tokens or 0) * prices.get("output", 0) / 1_000_000
+            + prices.get("request", 0)
+        )
+
+    def record_usage(
+        self, key: str, model: str, prompt_tokens: int, completion_tokens: int
+    ):
+        """扣减估算费用，并在需要时安排一次余额核实"""
+        record = key_pool.get(key)
+        if record is None:
+            return
+
+        before = record.balance
+        cost = self.estimate_cost(model, prompt_tokens, completion_tokens)
+        if cost > 0:
+            key_pool.update_balance(key, before - cost)
+        after = before - cost
+
+        threshold = config.BALANCE_CHECK_THRESHOLD
+        crossed = before > threshold >= after
+        # 使用密钥池记录的核实时间，不再单独维护一份按key的时间表
+        interval = config.BALANCE_CHECK_INTERVAL
+        stale = time.time() - (record.last_checked or 0) >= interval
+        if crossed or stale:
+            self.schedule_check(key)
+
+    def schedule_check(self, key: str):
+        """安排一次余额核实，同一key已有进行中的核实时直接复用"""
+        task = self._pending.get(key)
+        if task is not None:
+            return task
+        task = asyncio.create_task(check_and_remove_key(key))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return task
+
+
+# 全局余额跟踪器
+balance_tracker = BalanceTracker()
@@ -0,0 +1,126 @@
+import time
+import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """单个key的熔断器
+
+    closed：正常使用，连续失败达到阈值后进入 open；
+    open：冷却期内不参与选择，冷却时间随连续熔断次数指数增长；
+    half_open：冷却结束后只放行一个试探请求，成功则恢复 closed，失败则重新 open。
+    """
+
+    __slots__ = ("state", "failures", "trips", "opened_at", "cooldown", "trial_at")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.trial_at = None
+
+    def can_attempt(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now - self.opened_at >= self.cooldown
+        # 试探请求迟迟没有结果时（例如客户端中途断开），允许重新试探
+        return self.trial_at is None or now - self.trial_at >= self.cooldown
+
+    def on_dispatch(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            self.trial_at = now
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.trial_at = None
+
+    def record_failure(self, now: float):
+        self.failures += 1
+        if self.state == OPEN:
+            # 熔断前已发出的请求陆续失败，不应延长冷却
+            return
+        if self.state == HALF_OPEN or self.failures >= config.BREAKER_FAILURE_THRESHOLD:
+            self._open(now)
+
+    def _open(self, now: float):
+        self.trips += 1
+        self.state = OPEN
+        self.opened_at = now
+        self.cooldown = min(
+            config.BREAKER_BASE_COOLDOWN * 2 ** (self.trips - 1),
+            config.BREAKER_MAX_COOLDOWN,
+        )
+        self.trial_at = None
+
+
+class BreakerRegistry:
+    """按key管理熔断器，由转发结果驱动"""
+
+    def __init__(self):
+        self._breakers = {}
+        # 最近转发失败、尚未恢复的key
+        self._failing = set()
+
+    def _get(self, key: str) -> CircuitBreaker:
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            self._breakers[key] = breaker
+        return breaker
+
+    def can_attempt(self, key: str) -> bool:
+        breaker = self._breakers.get(key)
+        return breaker is None or breaker.can_attempt(time.monotonic())
+
+    def on_dispatch(self, key: str):
+        breaker = self._breakers.get(key)
+        if breaker is not None:
+            breaker.on_dispatch(time.monotonic())
+
+    def record_success(self, key: str):
+        breaker = self._breakers.get(key)
+        if breaker is not None and (breaker.failures or breaker.state != CLOSED):
+            breaker.record_success()
+            self._failing.discard(key)
+
+    def record_failure(self, key: str):
+        self._get(key).record_failure(time.monotonic())
+        self._failing.add(key)
+
+    def forget(self, key: str):
+        """丢弃已移除key的熔断状态"""
+        self._breakers.pop(key, None)
+        self._failing.discard(key)
+
+    def failing(self) -> list:
+        """返回记录了失败且尚未恢复的key"""
+        return list(self._failing)
+
+    def snapshot(self, key: str) -> dict:
+        """返回key的熔断状态，retry_in 为距离可以试探的剩余秒数"""
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            return {"state": CLOSED, "failures": 0, "retry_in": 0}
+        retry_in = 0
+        if breaker.state == OPEN:
+            elapsed = time.monotonic() - breaker.opened_at
+            retry_in = max(0, round(breaker.cooldown - elapsed))
+        return {
+            "state": breaker.state,
+            "failures": breaker.failures,
+            "retry_in": retry_in,
+        }
+
+
+# 全局熔断器
+circuit_breakers = BreakerRegistry()
@@ -9,6 +9,48 @@ DEFAULT_CONFIG = {
     "free_model_api_key": "",  # 空字符串表示不使用特殊token来调用免费模型的api_key
     "admin_username": "admin",  # 默认管理员用户名
     "admin_password": "admin",  # 默认管理员密码
+    "upstream_connect_timeout": 10,  # 上游连接超时（秒）
+    "upstream_pool_limit": 200,  # 上游连接池总连接数上限
+    "upstream_pool_limit_per_host": 100,  # 单个上游主机的连接数上限
+    "upstream_keepalive_timeout": 60,  # 空闲连接保活时间（秒）
+    "upstream_dns_cache_ttl": 300,  # DNS 缓存时间（秒）
+    "stream_include_usage": False,  # 流式请求是否自动注入 stream_options.include_usage
+    "upstream_max_attempts": 3,  # 上游失败时换key重试的总尝试次数
+    # 每个key在各模型上的限额（rpm: 每分钟请求数，tpm: 每分钟token数，0 表示不限制），
+    # 未单独配置的模型使用 default
+    "rate_limits": {"default": {"rpm": 1000, "tpm": 50000}},
+    "breaker_failure_threshold": 5,  # 连续失败多少次后熔断该key
+    "breaker_base_cooldown": 30,  # 首次熔断的冷却时间（秒），之后每次翻倍
+    "breaker_max_cooldown": 900,  # 熔断冷却时间上限（秒）
+    # 估算费用用的价格表（input/output: 元/百万token，request: 元/次），
+    # 未单独配置的模型使用 default
+    "model_prices": {"default": {"input": 0, "output": 0, "request": 0}},
+    "balance_check_threshold": 1.0,  # 估算余额跌破该值时立即向上游核实
+    "balance_check_interval": 600,  # 同一key两次核实余额的最小间隔（秒）
+    "write_buffer_batch_size": 500,  # 缓冲的日志达到多少条时立即写入数据库
+    "write_buffer_flush_interval_ms": 500,  # 缓冲最长多久写入一次数据库（毫秒）
+    "write_buffer_max_size": 10000,  # 缓冲上限，写满后新请求等待写入完成
+    "max_page_size": 100,  # 日志与密钥列表每页条数上限
+    "log_retention_days": 0,  # 原始日志保留天数，0 表示永久保留（汇总统计始终保留）
+    "log_archive_dir": "archives",  # 过期日志归档目录，按月写入 gzip 压缩的 NDJSON 文件
+    "refresh_concurrency": 20,  # 批量刷新余额时同时验证的key数量
+    "refresh_batch_size": 100,  # 批量刷新时每多少个结果提交一次数据库
+    "import_concurrency": 20,  # 批量导入时同时验证的key数量
+    "import_batch_size": 500,  # 批量导入时每多少个有效key写入一次数据库
+    "embedding_cache_size": 2000,  # 内存中缓存的 embedding 条数，0 表示关闭缓存
+    "embedding_cache_max_rows": 0,  # 数据库中最多缓存的 embedding 条数，0 表示不持久化
+    "embedding_cache_ttl": 604800,  # embedding 缓存的有效期（秒）
+    "embedding_batch_window_ms": 0,  # 合并小 embeddings 请求时最多等待的时间（毫秒），0 表示不合并
+    "embedding_batch_max_items": 64,  # 合并后单次上游请求最多包含的输入条数
+    "embedding_batch_max_tokens": 8000,  # 合并后单次上游请求最多包含的估计 token 数
+    "fanout_embedding_chunk_size": 256,  # embeddings 输入超过此条数时分块并发发送，0 表示不拆分
+    "fanout_rerank_chunk_size": 200,  # rerank 文档超过此数量时分块并发发送，0 表示不拆分
+    "fanout_concurrency": 8,  # 单个请求拆分后同时发送的分块数量
+    "models_cache_ttl": 600,  # /v1/models 响应的缓存时间（秒），过期后先返回旧数据并在后台刷新，0 表示不缓存
+    "single_flight_endpoints": ["embeddings", "rerank", "models"],  # 合并相同并发请求的接口
+    "single_flight_window_ms": 50,  # 上游返回后结果继续供相同请求复用的时间（毫秒）
+    "revalidate_jitter": 0.2,  # 滚动核实间隔的随机抖动比例
+    "revalidate_min_delay": 1,  # 滚动核实两次之间的最小间隔（秒）
 }
 
 if os.path.exists(CONFIG_FILE):
@@ -29,6 +71,110 @@ CUSTOM_API_KEY = config.get("custom_api_key", DEFAULT_CONFIG["custom_api_key"])
 FREE_MODEL_API_KEY = config.get("free_model_api_key", DEFAULT_CONFIG["free_model_api_key"])
 ADMIN_USERNAME = config.get("admin_username", DEFAULT_CONFIG["admin_username"])
 ADMIN_PASSWORD = config.get("admin_password", DEFAULT_CONFIG["admin_password"])
+UPSTREAM_CONNECT_TIMEOUT = config.get(
+    "upstream_connect_timeout", DEFAULT_CONFIG["upstream_connect_timeout"]
+)
+UPSTREAM_POOL_LIMIT = config.get(
+    "upstream_pool_limit", DEFAULT_CONFIG["upstream_pool_limit"]
+)
+UPSTREAM_POOL_LIMIT_PER_HOST = config.get(
+    "upstream_pool_limit_per_host", DEFAULT_CONFIG["upstream_pool_limit_per_host"]
+)
+UPSTREAM_KEEPALIVE_TIMEOUT = config.get(
+    "upstream_keepalive_timeout", DEFAULT_CONFIG["upstream_keepalive_timeout"]
+)
+UPSTREAM_DNS_CACHE_TTL = config.get(
+    "upstream_dns_cache_ttl", DEFAULT_CONFIG["upstream_dns_cache_ttl"]
+)
+STREAM_INCLUDE_USAGE = config.get(
+    "stream_include_usage", DEFAULT_CONFIG["stream_include_usage"]
+)
+UPSTREAM_MAX_ATTEMPTS = config.get(
+    "upstream_max_attempts", DEFAULT_CONFIG["upstream_max_attempts"]
+)
+RATE_LIMITS = config.get("rate_limits", DEFAULT_CONFIG["rate_limits"])
+BREAKER_FAILURE_THRESHOLD = config.get(
+    "breaker_failure_threshold", DEFAULT_CONFIG["breaker_failure_threshold"]
+)
+BREAKER_BASE_COOLDOWN = config.get(
+    "breaker_base_cooldown", DEFAULT_CONFIG["breaker_base_cooldown"]
+)
+BREAKER_MAX_COOLDOWN = config.get(
+    "breaker_max_cooldown", DEFAULT_CONFIG["breaker_max_cooldown"]
+)
+MODEL_PRICES = config.get("model_prices", DEFAULT_CONFIG["model_prices"])
+BALANCE_CHECK_THRESHOLD = config.get(
+    "balance_check_threshold", DEFAULT_CONFIG["balance_check_threshold"]
+)
+BALANCE_CHECK_INTERVAL = config.get(
+    "balance_check_interval", DEFAULT_CONFIG["balance_check_interval"]
+)
+WRITE_BUFFER_BATCH_SIZE = config.get(
+    "write_buffer_batch_size", DEFAULT_CONFIG["write_buffer_batch_size"]
+)
+WRITE_BUFFER_FLUSH_INTERVAL_MS = config.get(
+    "write_buffer_flush_interval_ms", DEFAULT_CONFIG["write_buffer_flush_interval_ms"]
+)
+WRITE_BUFFER_MAX_SIZE = config.get(
+    "write_buffer_max_size", DEFAULT_CONFIG["write_buffer_max_size"]
+)
+MAX_PAGE_SIZE = config.get("max_page_size", DEFAULT_CONFIG["max_page_size"])
+LOG_RETENTION_DAYS = config.get(
+    "log_retention_days", DEFAULT_CONFIG["log_retention_days"]
+)
+LOG_ARCHIVE_DIR = config.get("log_archive_dir", DEFAULT_CONFIG["log_archive_dir"])
+REFRESH_CONCURRENCY = config.get(
+    "refresh_concurrency", DEFAULT_CONFIG["refresh_concurrency"]
+)
+REFRESH_BATCH_SIZE = config.get(
+    "refresh_batch_size", DEFAULT_CONFIG["refresh_batch_size"]
+)
+IMPORT_CONCURRENCY = config.get(
+    "import_concurrency", DEFAULT_CONFIG["import_concurrency"]
+)
+IMPORT_BATCH_SIZE = config.get(
+    "import_batch_size", DEFAULT_CONFIG["import_batch_size"]
+)
+EMBEDDING_CACHE_SIZE = config.get(
+    "embedding_cache_size", DEFAULT_CONFIG["embedding_cache_size"]
+)
+EMBEDDING_CACHE_MAX_ROWS = config.get(
+    "embedding_cache_max_rows", DEFAULT_CONFIG["embedding_cache_max_rows"]
+)
+EMBEDDING_CACHE_TTL = config.get(
+    "embedding_cache_ttl", DEFAULT_CONFIG["embedding_cache_ttl"]
+)
+EMBEDDING_BATCH_WINDOW_MS = config.get(
+    "embedding_batch_window_ms", DEFAULT_CONFIG["embedding_batch_window_ms"]
+)
+EMBEDDING_BATCH_MAX_ITEMS = config.get(
+    "embedding_batch_max_items", DEFAULT_CONFIG["embedding_batch_max_items"]
+)
+EMBEDDING_BATCH_MAX_TOKENS = config.get(
+    "embedding_batch_max_tokens", DEFAULT_CONFIG["embedding_batch_max_tokens"]
+)
+FANOUT_EMBEDDING_CHUNK_SIZE = config.get(
+    "fanout_embedding_chunk_size", DEFAULT_CONFIG["fanout_embedding_chunk_size"]
+)
+FANOUT_RERANK_CHUNK_SIZE = config.get(
+    "fanout_rerank_chunk_size", DEFAULT_CONFIG["fanout_rerank_chunk_size"]
+)
+FANOUT_CONCURRENCY = config.get(
+    "fanout_concurrency", DEFAULT_CONFIG["fanout_concurrency"]
+)
+MODELS_CACHE_TTL = config.get("models_cache_ttl", DEFAULT_CONFIG["models_cache_ttl"])
+SINGLE_FLIGHT_ENDPOINTS = config.get(
+    "single_flight_endpoints", DEFAULT_CONFIG["single_flight_endpoints"]
+)
+SINGLE_FLIGHT_WINDOW_MS = config.get(
+    "single_flight_window_ms", DEFAULT_CONFIG["single_flight_window_ms"]
+)
+REVALIDATE_JITTER = config.get(
+    "revalidate_jitter", DEFAULT_CONFIG["revalidate_jitter"]
+)
+REVALIDATE_MIN_DELAY = config.get(
+    "revalidate_min_delay", DEFAULT_CONFIG["revalidate_min_delay"]
+)
 
 
 def save_config():
@@ -1,14 +1,462 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
 import sqlite3
+import threading
 import time
+import config
 
-# 全局数据库连接
-conn = sqlite3.connect("pool.db", check_same_thread=False)
-cursor = conn.cursor()
+DB_FILE = "pool.db"
 
+# 读连接池的大小
+READER_THREADS = 4
 
-def init_db():
-    """初始化数据库表结构"""
-    cursor.execute("""
+# 汇总统计的时间粒度（毫秒）
+ROLLUP_BUCKET_MS = 3600 * 1000
+
+# 日志中 key、模型与接口名称对应的维度表
+DIMENSION_TABLES = ("log_keys", "log_models", "log_endpoints")
+
+# 查询日志时使用的列顺序，与 format_log_rows 对应
+LOG_COLUMNS = "key_id, model_id, endpoint_id, call_time, input_tokens, output_tokens, total_tokens, tried_keys, id"
+
+
+def connect() -> sqlite3.Connection:
+    """创建一个新的数据库连接"""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class Database:
+    """pool.db 的异步访问层
+
+    所有写操作排队交给唯一的写线程执行，每个操作在一个事务中完成；
+    读操作在读线程池中执行，每个读线程持有自己的连接。
+    数据库使用 WAL 模式，读操作不会被写操作阻塞。
+    调用方拿到的都是可等待对象，事件循环上不会发生 SQLite I/O。
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._writer = None
+        self._readers = self._create_readers()
+        self._local = threading.local()
+        # 所有读线程创建的连接，停止时统一关闭
+        self._reader_conns = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create_readers() -> concurrent.futures.ThreadPoolExecutor:
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=READER_THREADS, thread_name_prefix="db-reader"
+        )
+
+    def start(self):
+        """启动写线程"""
+        with self._lock:
+            if self._writer and self._writer.is_alive():
+                return
+            self._writer = threading.Thread(
+                target=self._write_loop, name="db-writer", daemon=True
+            )
+            self._writer.start()
+
+    def stop(self):
+        """处理完已排队的写操作后停止写线程，并关闭读线程池及其连接"""
+        with self._lock:
+            writer = self._writer
+            self._writer = None
+            readers, self._readers = self._readers, self._create_readers()
+        if writer and writer.is_alive():
+            self._queue.put(None)
+            writer.join()
+        readers.shutdown(wait=True)
+        with self._lock:
+            conns, self._reader_conns = self._reader_conns, []
+        for conn in conns:
+            conn.close()
+
+    def _write_loop(self):
+        conn = connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with conn:
+                    result = fn(conn)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+        conn.close()
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect()
+            self._local.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def write(self, fn):
+        """在写线程的一个事务中执行 fn(conn)，返回可等待的结果"""
+        if not self._writer:
+            self.start()
+        future = concurrent.futures.Future()
+        self._queue.put((fn, future))
+        return asyncio.wrap_future(future)
+
+    def read(self, fn):
+        """在读线程中执行 fn(conn)，返回可等待的结果"""
+        return asyncio.wrap_future(
+            self._readers.submit(lambda: fn(self._reader_conn()))
+        )
+
+    def execute(self, sql: str, params=()):
+        """执行一条写语句，结果为受影响的行数"""
+        return self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    def executemany(self, sql: str, seq_of_params):
+        """批量执行一条写语句，结果为受影响的行数"""
+        seq_of_params = list(seq_of_params)
+        return self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def fetchall(self, sql: str, params=()):
+        return self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def fetchone(self, sql: str, params=()):
+        return self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+
+# 全局数据库访问层
+database = Database()
+
+
+def _rollup_logs(rows: list) -> list:
+    """把一批已转换为id的日志行按 (小时, 模型, 接口, key) 汇总为 log_rollups 的增量
+
+    log_rollups 的主键不允许出现 NULL 才能正确合并，未知的维度使用 0 表示。
+    """
+    totals = {}
+    for key_id, model_id, endpoint_id, call_time, input_tokens, output_tokens, total_tokens, _ in rows:
+        bucket = (
+            call_time // ROLLUP_BUCKET_MS * ROLLUP_BUCKET_MS,
+            model_id or 0,
+            endpoint_id or 0,
+            key_id or 0,
+        )
+        entry = totals.get(bucket)
+        if entry is None:
+            entry = totals[bucket] = [0, 0, 0, 0]
+        entry[0] += 1
+        entry[1] += input_tokens or 0
+        entry[2] += output_tokens or 0
+        entry[3] += total_tokens or 0
+    return [bucket + tuple(entry) for bucket, entry in totals.items()]
+
+
+class LogDimensions:
+    """日志中的 key、模型与接口名称与整数 id 的对应关系
+
+    logs 与 log_rollups 只保存整数 id，名称保存在 log_keys / log_models / log_endpoints
+    三张小表中。启动时整体加载到内存，之后只有写线程会分配新的 id，
+    查询时直接在内存中完成 id 与名称的互相转换，日志页的筛选下拉框也直接读取内存。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {table: {} for table in DIMENSION_TABLES}
+        self._names = {table: {} for table in DIMENSION_TABLES}
+
+    def load(self, conn: sqlite3.Connection = None):
+        """从数据库加载全部名称，未传入连接时自行打开（启动时同步执行）"""
+        own = conn is None
+        if own:
+            conn = connect()
+        try:
+            loaded = {
+                table: conn.execute(f"SELECT id, name FROM {table}").fetchall()
+                for table in DIMENSION_TABLES
+            }
+        finally:
+            if own:
+                conn.close()
+        with self._lock:
+            for table, rows in loaded.items():
+                self._ids[table] = {name: id_ for id_, name in rows}
+                self._names[table] = {id_: name for id_, name in rows}
+
+    def intern(self, conn: sqlite3.Connection, table: str, names) -> dict:
+        """为名称分配id（只能在写线程中调用），返回 名称 -> id"""
+        with self._lock:
+            ids = self._ids[table]
+            missing = {name for name in names if name and name not in ids}
+        for name in missing:
+            conn.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+            id_ = conn.execute(
+                f"SELECT id FROM {table} WHERE name = ?", (name,)
+            ).fetchone()[0]
+            with self._lock:
+                self._ids[table][name] = id_
+                self._names[table][id_] = name
+        with self._lock:
+            return dict(self._ids[table])
+
+    def id_of(self, table: str, name: str):
+        with self._lock:
+            return self._ids[table].get(name)
+
+    def name_of(self, table: str, id_: int):
+        with self._lock:
+            return self._names[table].get(id_)
+
+    def names_of(self, table: str) -> dict:
+        """返回 id -> 名称 的副本"""
+        with self._lock:
+            return dict(self._names[table])
+
+    def clear(self):
+        with self._lock:
+            self._ids = {table: {} for table in DIMENSION_TABLES}
+            self._names = {table: {} for table in DIMENSION_TABLES}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "models": sorted(self._ids["log_models"]),
+                "endpoints": sorted(self._ids["log_endpoints"]),
+            }
+
+
+# 全局日志维度缓存
+log_dimensions = LogDimensions()
+
+
+def format_log_rows(rows: list) -> list:
+    """把 logs 表的行 (key_id, model_id, endpoint_id, call_time, input_tokens,
+    output_tokens, total_tokens, tried_keys, ...) 还原为接口返回的字典"""
+    keys = log_dimensions.names_of("log_keys")
+    models = log_dimensions.names_of("log_models")
+    endpoints = log_dimensions.names_of("log_endpoints")
+    return [
+        {
+            "used_key": keys.get(row[0]),
+            "model": models.get(row[1]),
+            "call_time": row[3] / 1000,
+            "input_tokens": row[4],
+            "output_tokens": row[5],
+            "total_tokens": row[6],
+            # 为了向后兼容，对空值使用默认值
+            "endpoint": endpoints.get(row[2]) or "未知",
+            "tried_keys": [keys.get(int(i)) for i in row[7].split(",")]
+            if row[7]
+            else [],
+        }
+        for row in rows
+    ]
+
+
+class WriteBuffer:
+    """日志与调用次数的写缓冲
+
+    调用日志和 usage_count 增量先在内存中累积，达到批量大小或超过刷新间隔时
+    通过 executemany 在一个事务中写入，避免每个请求单独提交。
+    缓冲写满后新的日志需要等待下一次写入完成（背压）。
+    """
+
+    def __init__(self):
+        self._logs = []
+        self._usage = {}
+        self._task = None
+        self._closing = False
+        self._wakeup = None
+        self._space = None
+        self._flush_lock = None
+        # 监控指标
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.dropped_rows = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.max_depth = 0
+
+    def _ensure_primitives(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._space = asyncio.Condition()
+            self._flush_lock = asyncio.Lock()
+
+    @property
+    def depth(self) -> int:
+        return len(self._logs) + len(self._usage)
+
+    def start(self):
+        """启动定时写入任务"""
+        self._ensure_primitives()
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止定时写入任务，并写入缓冲中剩余的数据
+
+        不取消后台任务：取消可能发生在 flush 已经取出缓冲数据、写操作尚未执行时，
+        那批数据会丢失。这里通知任务在当前这次写入完成后退出。
+        """
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(),
+                    timeout=config.WRITE_BUFFER_FLUSH_INTERVAL_MS / 1000,
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # 后台任务退出后缓冲写满，所有 add_log 都会一直等待，这里只记录错误
+                logging.error(f"写入缓冲任务出错: {e}")
+
+    async def add_log(self, row: tuple):
+        """加入一条日志，缓冲已满时等待写入"""
+        self._ensure_primitives()
+        if len(self._logs) >= config.WRITE_BUFFER_MAX_SIZE:
+            if self._task is None:
+                # 没有后台写入任务时直接写入
+                await self.flush()
+            self._wakeup.set()
+            async with self._space:
+                await self._space.wait_for(
+                    lambda: len(self._logs) < config.WRITE_BUFFER_MAX_SIZE
+                )
+        self._logs.append(row)
+        self.max_depth = max(self.max_depth, self.depth)
+        if len(self._logs) >= config.WRITE_BUFFER_BATCH_SIZE:
+            self._wakeup.set()
+
+    def add_usage(self, key: str, count: int = 1):
+        """累加key的调用次数增量（同一key的增量会合并）"""
+        self._usage[key] = self._usage.get(key, 0) + count
+
+    async def flush(self):
+        """把当前缓冲的数据在一个事务中写入数据库"""
+        self._ensure_primitives()
+        async with self._flush_lock:
+            logs, self._logs = self._logs, []
+            usage, self._usage = self._usage, {}
+            async with self._space:
+                self._space.notify_all()
+            if not logs and not usage:
+                return
+
+            def apply(conn):
+                if logs:
+                    used_keys = set()
+                    for row in logs:
+                        used_keys.add(row[0])
+                        used_keys.update(row[7] or ())
+                    key_ids = log_dimensions.intern(conn, "log_keys", used_keys)
+                    model_ids = log_dimensions.intern(
+                        conn, "log_models", {row[1] for row in logs}
+                    )
+                    endpoint_ids = log_dimensions.intern(
+                        conn, "log_endpoints", {row[6] for row in logs}
+                    )
+                    rows = [
+                        (
+                            key_ids.get(used_key),
+                            model_ids.get(model),
+                            endpoint_ids.get(endpoint),
+                            int(call_time * 1000),
+                            input_tokens,
+                            output_tokens,
+                            total_tokens,
+                            ",".join(str(key_ids[k]) for k in tried_keys)
+                            if tried_keys
+                            else None,
+                        )
+                        for used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint, tried_keys in logs
+                    ]
+                    conn.executemany(
+                        "INSERT INTO logs (key_id, model_id, endpoint_id, call_time, input_tokens, output_tokens, total_tokens, tried_keys) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+                    conn.executemany(
+                        """
+                        INSERT INTO log_rollups (hour_start, model_id, endpoint_id, key_id, calls, input_tokens, output_tokens, total_tokens)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (hour_start, model_id, endpoint_id, key_id) DO UPDATE SET
+                            calls = calls + excluded.calls,
+                            input_tokens = input_tokens + excluded.input_tokens,
+                            output_tokens = output_tokens + excluded.output_tokens,
+                            total_tokens = total_tokens + excluded.total_tokens
+                        """,
+                        _rollup_logs(rows),
+                    )
+                if usage:
+                    conn.executemany(
+                        "UPDATE api_keys SET usage_count = usage_count + ? WHERE key = ?",
+                        [(count, key) for key, count in usage.items()],
+                    )
+
+            start = time.perf_counter()
+            try:
+                # 数据已经移出缓冲，即使调用方被取消也要让这次写入完成
+                await asyncio.shield(database.write(apply))
+            except Exception as e:
+                self.dropped_rows += len(logs)
+                # 调用次数增量放回缓冲，下次重试
+                for key, count in usage.items():
+                    self.add_usage(key, count)
+                logging.error(f"写入缓冲数据失败，丢弃 {len(logs)} 条日志: {e}")
+                # 事务已回滚，内存中新分配的id可能并不存在，重新从数据库加载
+                try:
+                    await database.write(log_dimensions.load)
+                except Exception as e:
+                    logging.error(f"重新加载日志维度失败: {e}")
+                return
+            elapsed = (time.perf_counter() - start) * 1000
+            self.flushes += 1
+            self.flushed_rows += len(logs)
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+    def snapshot(self) -> dict:
+        return {
+            "pending_logs": len(self._logs),
+            "pending_usage_keys": len(self._usage),
+            "max_depth": self.max_depth,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "dropped_rows": self.dropped_rows,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+
+# 全局写缓冲
+write_buffer = WriteBuffer()
+
+
+def _migrate_initial_schema(conn: sqlite3.Connection):
+    """版本1：基础表结构"""
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS api_keys (
         key TEXT PRIMARY KEY,
         add_time REAL,
@@ -17,10 +465,9 @@ def init_db():
         enabled INTEGER DEFAULT 1
     )
     """)
-    conn.commit()
 
     # 创建日志表以记录API调用
-    cursor.execute("""
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS logs (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         used_key TEXT,
@@ -32,29 +479,269 @@ def init_db():
         endpoint TEXT
     )
     """)
-    conn.commit()
 
     # 创建会话表以存储用户会话
-    cursor.execute("""
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS sessions (
         token TEXT PRIMARY KEY,
         expiry_time REAL,
         created_at REAL
     )
     """)
-    conn.commit()
 
 
-def insert_api_key(api_key: str, balance: float):
+def _migrate_tried_keys(conn: sqlite3.Connection):
+    """版本2：日志表记录重试过的key"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(logs)")]
+    if "tried_keys" not in columns:
+        conn.execute("ALTER TABLE logs ADD COLUMN tried_keys TEXT")
+
+
+def _migrate_indexes(conn: sqlite3.Connection):
+    """版本3：为日志筛选、统计和密钥选择建立索引"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_call_time ON logs(call_time)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_logs_model_time ON logs(model, call_time)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_logs_endpoint_time ON logs(endpoint, call_time)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_logs_key_time ON logs(used_key, call_time)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_api_keys_enabled_balance ON api_keys(enabled, balance)"
+    )
+
+
+def _migrate_rollups(conn: sqlite3.Connection):
+    """版本4：按小时汇总的调用统计表，并用已有日志回填"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS log_rollups (
+        hour_start INTEGER,
+        model TEXT,
+        endpoint TEXT,
+        used_key TEXT,
+        calls INTEGER,
+        input_tokens INTEGER,
+        output_tokens INTEGER,
+        total_tokens INTEGER,
+        PRIMARY KEY (hour_start, model, endpoint, used_key)
+    )
+    """)
+    conn.execute("DELETE FROM log_rollups")
+    conn.execute("""
+    INSERT INTO log_rollups
+    SELECT CAST(call_time / 3600 AS INTEGER) * 3600,
+           COALESCE(model, ''), COALESCE(endpoint, ''), COALESCE(used_key, ''),
+           COUNT(*), COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0),
+           COALESCE(SUM(total_tokens), 0)
+    FROM logs
+    GROUP BY 1, 2, 3, 4
+    """)
+
+
+def _migrate_dimensions(conn: sqlite3.Connection):
+    """版本5：记录日志中出现过的模型与接口名称，用于日志页筛选"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS log_models (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS log_endpoints (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    )
+    """)
+    conn.execute(
+        "INSERT OR IGNORE INTO log_models (name) SELECT DISTINCT model FROM logs WHERE model IS NOT NULL AND model != ''"
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO log_endpoints (name) SELECT DISTINCT endpoint FROM logs WHERE endpoint IS NOT NULL AND endpoint != ''"
+    )
+
+
+def _migrate_interned_logs(conn: sqlite3.Connection):
+    """版本6：日志改为保存 key/模型/接口的整数id与毫秒时间戳
+
+    重建 logs 与 log_rollups 两张表，旧数据按名称换算为id后写入新表。
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS log_keys (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    )
+    """)
+    conn.execute(
+        "INSERT OR IGNORE INTO log_keys (name) SELECT DISTINCT used_key FROM logs WHERE used_key IS NOT NULL AND used_key != ''"
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO log_models (name) SELECT DISTINCT model FROM logs WHERE model IS NOT NULL AND model != ''"
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO log_endpoints (name) SELECT DISTINCT endpoint FROM logs WHERE endpoint IS NOT NULL AND endpoint != ''"
+    )
+
+    # 重试过的key列表很少出现，在 Python 中逐条换算
+    tried_rows = conn.execute(
+        "SELECT id, tried_keys FROM logs WHERE tried_keys IS NOT NULL AND tried_keys != ''"
+    ).fetchall()
+    tried_ids = {}
+    for log_id, tried_keys in tried_rows:
+        ids = []
+        for key in tried_keys.split(","):
+            conn.execute("INSERT OR IGNORE INTO log_keys (name) VALUES (?)", (key,))
+            ids.append(
+                str(
+                    conn.execute(
+                        "SELECT id FROM log_keys WHERE name = ?", (key,)
+                    ).fetchone()[0]
+                )
+            )
+        tried_ids[log_id] = ",".join(ids)
+
+    conn.execute("""
+    CREATE TABLE logs_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key_id INTEGER,
+        model_id INTEGER,
+        endpoint_id INTEGER,
+        call_time INTEGER,
+        input_tokens INTEGER,
+        output_tokens INTEGER,
+        total_tokens INTEGER,
+        tried_keys TEXT
+    )
+    """)
+    conn.execute("""
+    INSERT INTO logs_new
+    SELECT l.id, k.id, m.id, e.id, CAST(ROUND(l.call_time * 1000) AS INTEGER),
+           l.input_tokens, l.output_tokens, l.total_tokens, NULL
+    FROM logs l
+    LEFT JOIN log_keys k ON k.name = l.used_key
+    LEFT JOIN log_models m ON m.name = l.model
+    LEFT JOIN log_endpoints e ON e.name = l.endpoint
+    """)
+    conn.executemany(
+        "UPDATE logs_new SET tried_keys = ? WHERE id = ?",
+        [(ids, log_id) for log_id, ids in tried_ids.items()],
+    )
+    conn.execute("DROP TABLE logs")
+    conn.execute("ALTER TABLE logs_new RENAME TO logs")
+    conn.execute("CREATE INDEX idx_logs_call_time ON logs(call_time)")
+    conn.execute("CREATE INDEX idx_logs_model_time ON logs(model_id, call_time)")
+    conn.execute(
+        "CREATE INDEX idx_logs_endpoint_time ON logs(endpoint_id, call_time)"
+    )
+    conn.execute("CREATE INDEX idx_logs_key_time ON logs(key_id, call_time)")
+
+    conn.execute("""
+    CREATE TABLE log_rollups_new (
+        hour_start INTEGER,
+        model_id INTEGER,
+        endpoint_id INTEGER,
+        key_id INTEGER,
+        calls INTEGER,
+        input_tokens INTEGER,
+        output_tokens INTEGER,
+        total_tokens INTEGER,
+        PRIMARY KEY (hour_start, model_id, endpoint_id, key_id)
+    )
+    """)
+    conn.execute("""
+    INSERT INTO log_rollups_new
+    SELECT r.hour_start * 1000, COALESCE(m.id, 0), COALESCE(e.id, 0), COALESCE(k.id, 0),
+           SUM(r.calls), SUM(r.input_tokens), SUM(r.output_tokens), SUM(r.total_tokens)
+    FROM log_rollups r
+    LEFT JOIN log_keys k ON k.name = r.used_key
+    LEFT JOIN log_models m ON m.name = r.model
+    LEFT JOIN log_endpoints e ON e.name = r.endpoint
+    GROUP BY 1, 2, 3, 4
+    """)
+    conn.execute("DROP TABLE log_rollups")
+    conn.execute("ALTER TABLE log_rollups_new RENAME TO log_rollups")
+
+
+def _migrate_last_checked(conn: sqlite3.Connection):
+    """版本7：记录每个key最近一次核实余额的时间，供后台轮转核实使用"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(api_keys)")]
+    if "last_checked" not in columns:
+        conn.execute("ALTER TABLE api_keys ADD COLUMN last_checked REAL")
+
+
+def _migrate_embedding_cache(conn: sqlite3.Connection):
+    """版本8：embeddings 结果的持久化缓存"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        hash TEXT PRIMARY KEY,
+        embedding TEXT,
+        created_at REAL
+    )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_embedding_cache_created ON embedding_cache(created_at)"
+    )
+
+
+# 按顺序排列的迁移，第 i 个迁移把数据库升级到版本 i+1。
+# 已发布的迁移不要修改，新的表结构变化追加到末尾。
+MIGRATIONS = [
+    _migrate_initial_schema,
+    _migrate_tried_keys,
+    _migrate_indexes,
+    _migrate_rollups,
+    _migrate_dimensions,
+    _migrate_interned_logs,
+    _migrate_last_checked,
+    _migrate_embedding_cache,
+]
+
+
+def init_db():
+    """初始化数据库表结构并执行未完成的迁移（启动时同步执行）
+
+    当前版本记录在 PRAGMA user_version 中，每个迁移在独立的事务里执行并更新版本号。
+    迁移之前的旧版 pool.db 版本号为 0，所有迁移都按幂等方式编写，可以直接原地升级。
+    """
+    conn = connect()
+    conn.execute("PRAGMA journal_mode=WAL")
+    # 由迁移自己控制事务边界
+    conn.isolation_level = None
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            logging.info(f"数据库已升级到版本 {target}")
+
+        # 日志清理后由后台任务通过 incremental_vacuum 逐步回收空间，
+        # 旧数据库需要执行一次完整的 VACUUM 才能切换到增量模式
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            logging.info("数据库已切换为增量回收空间模式")
+    finally:
+        conn.close()
+
+
+async def insert_api_key(api_key: str, balance: float):
     """向数据库中插入新的API密钥"""
-    cursor.execute(
-        "INSERT OR IGNORE INTO api_keys (key, add_time, balance, usage_count, enabled) VALUES (?, ?, ?, ?, 1)",
-        (api_key, time.time(), balance, 0),
+    now = time.time()
+    await database.execute(
+        "INSERT OR IGNORE INTO api_keys (key, add_time, balance, usage_count, enabled, last_checked) VALUES (?, ?, ?, ?, 1, ?)",
+        (api_key, now, balance, 0, now),
     )
-    conn.commit()
 
 
-def log_completion(
+async def log_completion(
     used_key: str,
     model: str,
     call_time: float,
@@ -62,10 +749,13 @@ def log_completion(
     output_tokens: int,
     total_tokens: int,
     endpoint: str,
+    tried_keys: list = None,
 ):
-    """记录API调用日志"""
-    cursor.execute(
-        "INSERT INTO logs (used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    """记录API调用日志，发生过换key重试时一并记录按顺序尝试过的key
+
+    日志先进入写缓冲，由后台任务批量写入数据库。
+    """
+    await write_buffer.add_log(
         (
             used_key,
             model,
@@ -74,43 +764,40 @@ def log_completion(
             output_tokens,
             total_tokens,
             endpoint,
+            tuple(tried_keys) if tried_keys and len(tried_keys) > 1 else None,
         ),
     )
-    conn.commit()
 
 
-def create_session(token: str, expiry_time: float):
+async def create_session(token: str, expiry_time: float):
     """创建新的会话记录"""
-    cursor.execute(
+    await database.execute(
         "INSERT INTO sessions (token, expiry_time, created_at) VALUES (?, ?, ?)",
         (token, expiry_time, time.time()),
     )
-    conn.commit()
 
 
-def get_session(token: str):
+async def get_session(token: str):
     """获取会话信息"""
-    cursor.execute("SELECT expiry_time FROM sessions WHERE token = ?", (token,))
-    result = cursor.fetchone()
+    result = await database.fetchone(
+        "SELECT expiry_time FROM sessions WHERE token = ?", (token,)
+    )
     return result[0] if result else None
 
 
-def update_session_expiry(token: str, new_expiry_time: float):
+async def update_session_expiry(token: str, new_expiry_time: float):
     """更新会话过期时间"""
-    cursor.execute(
+    await database.execute(
         "UPDATE sessions SET expiry_time = ? WHERE token = ?", (new_expiry_time, token)
     )
-    conn.commit()
 
 
-def delete_session(token: str):
+async def delete_session(token: str):
     """删除会话"""
-    cursor.execute("DELETE FROM sessions WHERE token = ?", (token,))
-    conn.commit()
+    await database.execute("DELETE FROM sessions WHERE token = ?", (token,))
 
 
-def cleanup_expired_sessions():
+async def cleanup_expired_sessions():
     """清理所有过期会话"""
     current_time = time.time()
-    cursor.execute("DELETE FROM sessions WHERE expiry_time < ?", (current_time,))
-    conn.commit()
+    await database.execute("DELETE FROM sessions WHERE expiry_time < ?", (current_time,))
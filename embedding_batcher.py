@@ -0,0 +1,157 @@
+import asyncio
+import json
+import config
+
+
+def estimate_tokens(item) -> int:
+    """粗略估计单条输入的 token 数，字符串按字符数计，偏保守"""
+    if isinstance(item, list):
+        return len(item)
+    return max(1, len(item))
+
+
+class _Batch:
+    __slots__ = ("items", "tokens", "waiters", "call", "timer")
+
+    def __init__(self, call):
+        self.items = []
+        self.tokens = 0
+        # (future, 在合并后输入中的起始位置, 条数, 估计 token 数)
+        self.waiters = []
+        self.call = call
+        self.timer = None
+
+
+class EmbeddingBatcher:
+    """把同一模型的小 embeddings 请求合并成一次上游调用
+
+    第一个请求到达后最多等待 embedding_batch_window_ms 毫秒，期间参数相同的请求
+    把各自的 input 追加到同一批；条数或估计 token 数达到上限时立即发送。
+    上游返回后按位置把 data[] 拆回各个请求，usage 按估计 token 数分摊。
+    """
+
+    def __init__(self):
+        self._batches = {}
+        self.batches = 0
+        self.batched_requests = 0
+
+    @property
+    def enabled(self) -> bool:
+        return config.EMBEDDING_BATCH_WINDOW_MS > 0
+
+    async def submit(self, group: str, items: list, call):
+        """把 items 加入 group 对应的批次，返回该请求自己的 (status, data)
+
+        Args:
+            group: 决定能否合并的参数（模型、dimensions 等）的规范化表示
+            items: 本请求的输入列表
+            call: 协程函数，接收合并后的输入列表，返回上游的 (status, data)；
+                  每批只调用批次中第一个请求提供的 call
+        """
+        tokens = sum(estimate_tokens(item) for item in items)
+        batch = self._batches.get(group)
+        if batch is not None and (
+            len(batch.items) + len(items) > config.EMBEDDING_BATCH_MAX_ITEMS
+            or batch.tokens + tokens > config.EMBEDDING_BATCH_MAX_TOKENS
+        ):
+            # 放不下时先把当前批次发出去，本请求开始新的一批
+            self._flush(group, batch)
+            batch = None
+        if batch is None:
+            batch = _Batch(call)
+            self._batches[group] = batch
+            batch.timer = asyncio.get_running_loop().call_later(
+                config.EMBEDDING_BATCH_WINDOW_MS / 1000, self._flush, group, batch
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append((future, len(batch.items), len(items), tokens))
+        batch.items.extend(items)
+        batch.tokens += tokens
+        if (
+            len(batch.items) >= config.EMBEDDING_BATCH_MAX_ITEMS
+            or batch.tokens >= config.EMBEDDING_BATCH_MAX_TOKENS
+        ):
+            self._flush(group, batch)
+        return await future
+
+    def _flush(self, group: str, batch: _Batch):
+        if self._batches.get(group) is not batch:
+            return
+        del self._batches[group]
+        batch.timer.cancel()
+        self.batches += 1
+        self.batched_requests += len(batch.waiters)
+        asyncio.create_task(self._send(batch))
+
+    async def _send(self, batch: _Batch):
+        try:
+            status, data = await batch.call(batch.items)
+        except BaseException as e:
+            for future, *_ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        if len(batch.waiters) == 1:
+            future = batch.waiters[0][0]
+            if not future.done():
+                future.set_result((status, data))
+            return
+
+        entries = data.get("data") if status == 200 else None
+        if not isinstance(entries, list):
+            # 上游出错时每个请求都收到同样的错误
+            for future, *_ in batch.waiters:
+                if not future.done():
+                    future.set_result((status, data))
+            return
+
+        by_index = {entry.get("index"): entry for entry in entries}
+        usage = data.get("usage", {})
+        prompt_left = usage.get("prompt_tokens", 0)
+        total_left = usage.get("total_tokens", 0)
+        weight_left = batch.tokens
+        for future, start, count, tokens in batch.waiters:
+            # 按估计 token 数分摊 usage，最后一个请求拿走余数，保证总和不变
+            share = tokens / weight_left if weight_left else 1
+            prompt = round(prompt_left * share)
+            total = round(total_left * share)
+            prompt_left -= prompt
+            total_left -= total
+            weight_left -= tokens
+            part = {
+                **data,
+                "data": [
+                    {**by_index[start + i], "index": i}
+                    for i in range(count)
+                    if start + i in by_index
+                ],
+                "usage": {**usage, "prompt_tokens": prompt, "total_tokens": total},
+            }
+            if not future.done():
+                future.set_result((status, part))
+
+    def snapshot(self) -> dict:
+        return {
+            "pending_batches": len(self._batches),
+            "batches": self.batches,
+            "batched_requests": self.batched_requests,
+        }
+
+
+def batch_group(req_json: dict, use_zero_balance: bool) -> str:
+    """除 input 以外的参数都相同的请求才能合并"""
+    params = {k: v for k, v in req_json.items() if k != "input"}
+    return json.dumps(
+        [use_zero_balance, params],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+# 全局 embeddings 合并器
+embedding_batcher = EmbeddingBatcher()
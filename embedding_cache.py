@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+import config
+from db import database
+
+# 每写入多少条持久化缓存后清理一次过期和超出上限的条目
+TRIM_INTERVAL = 1000
+
+# 单条 SQL 中 IN 查询的最大参数个数
+LOOKUP_CHUNK = 500
+
+
+def split_inputs(value):
+    """把 embeddings 请求的 input 拆成可以逐条缓存的列表
+
+    Returns:
+        输入列表；input 的格式无法识别时返回 None，此时不使用缓存
+    """
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, list) or not value:
+        return None
+    # 单个 token 数组
+    if all(isinstance(item, int) for item in value):
+        return [value]
+    if all(isinstance(item, (str, list)) for item in value):
+        return value
+    return None
+
+
+class EmbeddingCache:
+    """按内容寻址的 embeddings 结果缓存
+
+    缓存键为 (model, 单条输入, dimensions, encoding_format) 的哈希，
+    值为上游返回的 embedding 的 JSON 文本。内存中是有上限的 LRU；
+    配置了 embedding_cache_max_rows 时同时写入 pool.db，重启后仍可命中。
+    两层都按 embedding_cache_ttl 过期。
+    """
+
+    def __init__(self):
+        # hash -> (created_at, embedding 的 JSON 文本)
+        self._memory = OrderedDict()
+        self._pending_trim = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    @property
+    def enabled(self) -> bool:
+        return config.EMBEDDING_CACHE_SIZE > 0
+
+    @staticmethod
+    def make_key(model: str, item, dimensions, encoding_format) -> str:
+        raw = json.dumps(
+            [model, item, dimensions, encoding_format],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get_many(self, hashes: list) -> dict:
+        """查找一组缓存键，返回命中的 {hash: embedding}"""
+        now = time.time()
+        cutoff = now - config.EMBEDDING_CACHE_TTL
+        found = {}
+        missing = []
+        for h in dict.fromkeys(hashes):
+            entry = self._memory.get(h)
+            if entry is not None and entry[0] >= cutoff:
+                self._memory.move_to_end(h)
+                found[h] = json.loads(entry[1])
+            else:
+                if entry is not None:
+                    del self._memory[h]
+                missing.append(h)
+
+        if missing and config.EMBEDDING_CACHE_MAX_ROWS > 0:
+            for start in range(0, len(missing), LOOKUP_CHUNK):
+                chunk = missing[start : start + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = await database.fetchall(
+                    f"SELECT hash, embedding, created_at FROM embedding_cache WHERE hash IN ({placeholders}) AND created_at >= ?",
+                    chunk + [cutoff],
+                )
+                for h, text, created_at in rows:
+                    found[h] = json.loads(text)
+                    self._remember(h, created_at, text)
+                    self.disk_hits += 1
+
+        hit_count = sum(1 for h in hashes if h in found)
+        self.hits += hit_count
+        self.misses += len(hashes) - hit_count
+        return found
+
+    def put_many(self, entries: dict):
+        """缓存 {hash: embedding}，持久化写入在后台进行"""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        for h, embedding in entries.items():
+            text = json.dumps(embedding, separators=(",", ":"))
+            self._remember(h, now, text)
+            rows.append((h, text, now))
+        self.stored += len(rows)
+
+        if config.EMBEDDING_CACHE_MAX_ROWS <= 0:
+            return
+        self._pending_trim += len(rows)
+        trim = self._pending_trim >= TRIM_INTERVAL
+        if trim:
+            self._pending_trim = 0
+
+        def apply(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (hash, embedding, created_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            if trim:
+                _trim(conn)
+
+        future = database.write(apply)
+        future.add_done_callback(_log_write_error)
+
+    def _remember(self, h: str, created_at: float, text: str):
+        self._memory[h] = (created_at, text)
+        self._memory.move_to_end(h)
+        while len(self._memory) > config.EMBEDDING_CACHE_SIZE:
+            self._memory.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "stored": self.stored,
+            "memory_entries": len(self._memory),
+        }
+
+
+def _trim(conn):
+    """删除过期条目，并在超出上限时删除最早写入的条目"""
+    conn.execute(
+        "DELETE FROM embedding_cache WHERE created_at < ?",
+        (time.time() - config.EMBEDDING_CACHE_TTL,),
+    )
+    count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+    excess = count - config.EMBEDDING_CACHE_MAX_ROWS
+    if excess > 0:
+        conn.execute(
+            "DELETE FROM embedding_cache WHERE hash IN (SELECT hash FROM embedding_cache ORDER BY created_at LIMIT ?)",
+            (excess,),
+        )
+
+
+def _log_write_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"写入 embedding 缓存失败: {future.exception()}")
+
+
+# 全局 embeddings 缓存
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,83 @@
+import asyncio
+import config
+
+
+def chunked(items: list, size: int) -> list:
+    """把列表按 size 切分成若干块"""
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+async def fan_out(chunks: list, send) -> list:
+    """以有限并发把每一块交给 send(chunk, in_use) 发送，按块的顺序返回结果
+
+    in_use 是所有块共享的集合，转发时会优先选择不在其中的key，
+    让各块分散到密钥池中不同的key上。
+    """
+    semaphore = asyncio.Semaphore(max(1, config.FANOUT_CONCURRENCY))
+    in_use = set()
+
+    async def run(chunk):
+        async with semaphore:
+            return await send(chunk, in_use)
+
+    return await asyncio.gather(*(run(chunk) for chunk in chunks))
+
+
+def _first_error(results: list):
+    for status, data in results:
+        if status != 200:
+            return status, data
+    return None
+
+
+def merge_embeddings(results: list, sizes: list):
+    """按原始顺序拼接各块的 embeddings 结果，usage 求和
+
+    Args:
+        results: 各块上游返回的 (status, data)
+        sizes: 各块的输入条数
+    """
+    error = _first_error(results)
+    if error is not None:
+        return error
+
+    merged = dict(results[0][1])
+    entries = []
+    usage = {}
+    offset = 0
+    for (_, data), size in zip(results, sizes):
+        for entry in data.get("data", []):
+            entries.append({**entry, "index": entry["index"] + offset})
+        for name, value in data.get("usage", {}).items():
+            if isinstance(value, (int, float)):
+                usage[name] = usage.get(name, 0) + value
+        offset += size
+    entries.sort(key=lambda entry: entry["index"])
+    merged["data"] = entries
+    merged["usage"] = usage
+    return 200, merged
+
+
+def merge_rerank(results: list, sizes: list, top_n: int = None):
+    """合并各块的 rerank 结果：换算回原始文档下标后按得分重新排序，token 用量求和"""
+    error = _first_error(results)
+    if error is not None:
+        return error
+
+    merged = dict(results[0][1])
+    ranked = []
+    tokens = {}
+    offset = 0
+    for (_, data), size in zip(results, sizes):
+        for result in data.get("results", []):
+            ranked.append({**result, "index": result["index"] + offset})
+        for name, value in data.get("meta", {}).get("tokens", {}).items():
+            if isinstance(value, (int, float)):
+                tokens[name] = tokens.get(name, 0) + value
+        offset += size
+    ranked.sort(key=lambda result: result.get("relevance_score", 0), reverse=True)
+    if top_n:
+        ranked = ranked[:top_n]
+    merged["results"] = ranked
+    merged["meta"] = {**merged.get("meta", {}), "tokens": tokens}
+    return 200, merged
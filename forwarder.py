@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import aiohttp
+import config
+from balance_tracker import balance_tracker
+from circuit_breaker import circuit_breakers
+from db import write_buffer
+from http_client import get_session, request_timeout
+from key_pool import key_pool
+from rate_limit import rate_limiter
+from utils import select_api_key
+
+# API基础URL
+BASE_URL = "https://api.siliconflow.cn"
+
+# 换key重试的上游状态码
+RETRYABLE_STATUSES = {401, 403, 429, 500, 502, 503, 504}
+
+# 说明key本身失效的状态码，需要在后台复查
+INVALID_KEY_STATUSES = {401, 403}
+
+# 计入熔断器失败次数的状态码（429 由限流跟踪处理，不视为key故障）
+BREAKER_FAILURE_STATUSES = {401, 403, 500, 502, 503, 504}
+
+# 不应转发给上游的逐跳请求头
+HOP_BY_HOP_HEADERS = {
+    "host",
+    "content-length",
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "upgrade",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class NoAvailableKeyError(Exception):
+    """没有可供选择的API密钥"""
+
+
+def _count_usage(key: str):
+    key_pool.increment_usage(key)
+    write_buffer.add_usage(key)
+
+
+async def forward_request(
+    method: str,
+    path: str,
+    headers: dict,
+    data: bytes = None,
+    timeout: float = None,
+    use_zero_balance: bool = False,
+    count_usage: bool = True,
+    model: str = None,
+    in_use: set = None,
+    tokens: int = 0,
+):
+    """选择密钥并转发请求，遇到可重试的状态码或连接错误时换key重试
+
+    同一请求中已经失败的key不会被再次选择，总尝试次数受 upstream_max_attempts 限制。
+    处于熔断冷却期的key不会被选择；指定 model 时还会优先跳过在该模型上
+    已经没有RPM/TPM余量的key（tokens 为请求预计消耗的token数）。每次尝试的结果都会反馈给该key的熔断器。
+    传入 in_use 时优先选择不在其中的key，并把选中的key加入其中，
+    用于让同时发出的多个分块请求分散到不同的key上。
+    count_usage 为真时只为最终返回响应的key累加调用次数。
+    返回的响应尚未读取，调用方负责读取并释放（``async with resp``）。
+
+    Returns:
+        (resp, selected, tried)：上游响应、最终使用的key、按顺序尝试过的全部key
+
+    Raises:
+        NoAvailableKeyError: 第一次尝试就没有可用的key
+        aiohttp.ClientConnectionError | asyncio.TimeoutError: 所有尝试都发生连接错误或超时
+    """
+    forward_headers = {
+        k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS
+    }
+    max_attempts = max(1, config.UPSTREAM_MAX_ATTEMPTS)
+    tried = []
+    resp = None
+    last_error = None
+
+    def has_headroom(key):
+        return (
+            key not in tried
+            and circuit_breakers.can_attempt(key)
+            and rate_limiter.can_accept(key, model, tokens)
+        )
+
+    def not_tried(key):
+        return key not in tried and circuit_breakers.can_attempt(key)
+
+    def done(key):
+        # 只有响应交给调用方的那次尝试计入调用次数，换key前失败的尝试不计
+        if count_usage:
+            _count_usage(key)
+        return resp, key, tried
+
+    def select(accept):
+        if in_use:
+            selected = select_api_key(
+                use_zero_balance, accept=lambda key: key not in in_use and accept(key)
+            )
+            if selected is not None:
+                return selected
+        return select_api_key(use_zero_balance, accept=accept)
+
+    while True:
+        selected = None
+        if model is not None:
+            selected = select(has_headroom)
+        if selected is None:
+            # 所有key都已接近限额时仍交给上游尝试，由上游做最终判断
+            selected = select(not_tried)
+        if selected is None:
+            if resp is not None:
+                # 没有其他key可换，把最后一次的上游响应交给客户端
+                return done(tried[-1])
+            if last_error is not None:
+                raise last_error
+            raise NoAvailableKeyError()
+
+        if resp is not None:
+            resp.release()
+            resp = None
+
+        tried.append(selected)
+        if in_use is not None:
+            in_use.add(selected)
+        circuit_breakers.on_dispatch(selected)
+        if model is not None:
+            rate_limiter.acquire(selected, model)
+        forward_headers["Authorization"] = f"Bearer {selected}"
+
+        try:
+            resp = await get_session().request(
+                method,
+                f"{BASE_URL}{path}",
+                headers=forward_headers,
+                data=data,
+                timeout=request_timeout(timeout),
+            )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            # 超时与连接失败同样计入熔断器并换key重试
+            last_error = e
+            circuit_breakers.record_failure(selected)
+            logger.warning(
+                f"Upstream request failed with key {selected[:8]}***: {e!r}"
+            )
+            if len(tried) >= max_attempts:
+                raise
+            continue
+
+        if model is not None:
+            rate_limiter.record_response(selected, model, resp.status, resp.headers)
+
+        if resp.status in BREAKER_FAILURE_STATUSES:
+            circuit_breakers.record_failure(selected)
+        elif resp.status != 429:
+            circuit_breakers.record_success(selected)
+
+        if resp.status not in RETRYABLE_STATUSES:
+            return done(selected)
+
+        logger.warning(
+            f"Upstream returned {resp.status} for key {selected[:8]}*** on {path}"
+        )
+        if resp.status in INVALID_KEY_STATUSES:
+            balance_tracker.schedule_check(selected)
+        if len(tried) >= max_attempts:
+            return done(selected)
@@ -0,0 +1,47 @@
+import aiohttp
+import config
+
+# 进程内共享的上游会话，在应用启动时创建、关闭时释放
+_session = None
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=config.UPSTREAM_POOL_LIMIT,
+        limit_per_host=config.UPSTREAM_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=config.UPSTREAM_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=config.UPSTREAM_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=request_timeout(None),
+    )
+
+
+def request_timeout(total) -> aiohttp.ClientTimeout:
+    """构造请求超时配置，连接阶段统一使用配置的连接超时"""
+    return aiohttp.ClientTimeout(
+        total=total, sock_connect=config.UPSTREAM_CONNECT_TIMEOUT
+    )
+
+
+def get_session() -> aiohttp.ClientSession:
+    """获取共享上游会话，不存在时创建"""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+async def start():
+    """在应用启动时创建共享会话"""
+    get_session()
+
+
+async def close():
+    """关闭共享会话"""
+    global _session
+    session, _session = _session, None
+    if session is not None and not session.closed:
+        await session.close()
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+
+
+class KeyBatchJob:
+    """一次批量处理key的后台任务的进度"""
+
+    def __init__(self, keys: list):
+        self.keys = keys
+        self.total = len(keys)
+        self.checked = 0
+        self.started_at = time.time()
+        self.finished = False
+        self.message = ""
+
+    def counters(self) -> dict:
+        """子类特有的计数，按顺序出现在进度快照中"""
+        return {}
+
+    def snapshot(self) -> dict:
+        return {
+            "total": self.total,
+            "checked": self.checked,
+            **self.counters(),
+            "finished": self.finished,
+            "message": self.message,
+        }
+
+
+class KeyBatchRunner(ABC):
+    """以固定数量的并发逐个处理key、数据库按批写入的后台任务
+
+    同一时间只运行一个任务，进度通过 progress() 推送给订阅者。
+    子类实现各抽象方法，提供并发与批量大小、单个key的验证、批量写入以及完成消息。
+    """
+
+    # 出错时日志与进度消息中的任务名称
+    name = "处理密钥"
+
+    def __init__(self):
+        self._job = None
+        self._task = None
+        self._changed = asyncio.Event()
+
+    @property
+    def job(self):
+        return self._job
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    @abstractmethod
+    def concurrency(self) -> int:
+        """同时验证的key数量"""
+
+    @property
+    @abstractmethod
+    def batch_size(self) -> int:
+        """累积多少条结果后写入一次数据库"""
+
+    @abstractmethod
+    async def process(self, job: KeyBatchJob, key: str):
+        """验证一个key，返回待写入的数据，不需要写入时返回None"""
+
+    @abstractmethod
+    async def write(self, job: KeyBatchJob, batch: list):
+        """在一个事务中写入一批 process() 的结果"""
+
+    @abstractmethod
+    def summary(self, job: KeyBatchJob) -> str:
+        """生成任务完成时的消息"""
+
+    def _launch(self, job: KeyBatchJob) -> KeyBatchJob:
+        self._job = job
+        self._task = asyncio.create_task(self._run(job))
+        return job
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def progress(self):
+        """依次产出当前任务的进度快照，任务结束后停止"""
+        while True:
+            changed = self._changed
+            job = self._job
+            if job is None:
+                return
+            yield job.snapshot()
+            if job.finished:
+                return
+            await changed.wait()
+
+    async def _run(self, job: KeyBatchJob):
+        pending = []
+        queue = asyncio.Queue()
+        for key in job.keys:
+            queue.put_nowait(key)
+
+        async def flush():
+            batch = pending[:]
+            pending.clear()
+            if batch:
+                await self.write(job, batch)
+
+        async def worker():
+            while True:
+                try:
+                    key = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                item = await self.process(job, key)
+                if item is not None:
+                    pending.append(item)
+                job.checked += 1
+                if len(pending) >= self.batch_size:
+                    await flush()
+                self._notify()
+
+        try:
+            workers = max(1, min(self.concurrency, job.total))
+            await asyncio.gather(*(worker() for _ in range(workers)))
+            await flush()
+            job.message = self.summary(job)
+        except Exception as e:
+            logging.error(f"{self.name}失败: {e}")
+            job.message = f"{self.name}失败: {e}"
+        finally:
+            job.finished = True
+            self._notify()
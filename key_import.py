@@ -0,0 +1,126 @@
+import time
+import config
+from db import database
+from key_batch import KeyBatchJob, KeyBatchRunner
+from key_pool import key_pool
+from utils import clean_key, validate_key_async, validate_key_format
+
+
+class KeyParser:
+    """逐块解析导入文本，一次遍历完成格式校验与去重
+
+    上传的文件可能很大，按块喂入即可，不需要先把整个文件读入内存再切分。
+    已在密钥池中或在本次导入中重复出现的key只计数，不再验证。
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.invalid_format = 0
+        self.duplicate = 0
+        self._tail = ""
+
+    def feed(self, text: str):
+        lines = (self._tail + text).split("\n")
+        self._tail = lines.pop()
+        for line in lines:
+            self._add(line)
+
+    def close(self) -> list:
+        """处理最后一行并返回待验证的key列表（保持原有顺序）"""
+        if self._tail:
+            self._add(self._tail)
+            self._tail = ""
+        return list(self.keys)
+
+    def _add(self, line: str):
+        line = line.strip()
+        if not line:
+            return
+        key = clean_key(line)
+        if not validate_key_format(key):
+            self.invalid_format += 1
+        elif key in self.keys or key in key_pool:
+            self.duplicate += 1
+        else:
+            self.keys[key] = None
+
+
+class ImportJob(KeyBatchJob):
+    """一次批量导入的进度"""
+
+    def __init__(self, keys: list, invalid_format: int, duplicate: int):
+        super().__init__(keys)
+        self.invalid_format = invalid_format
+        self.duplicate = duplicate
+        self.imported = 0
+        self.zero_balance = 0
+        self.invalid = 0
+
+    def counters(self) -> dict:
+        return {
+            "imported": self.imported,
+            "zero_balance": self.zero_balance,
+            "invalid": self.invalid,
+            "duplicate": self.duplicate,
+            "invalid_format": self.invalid_format,
+        }
+
+
+class KeyImporter(KeyBatchRunner):
+    """批量导入密钥
+
+    以固定数量的并发验证新key（共享上游连接池），验证通过的key按批用 executemany
+    写入数据库，每批一个事务，提交后再加入内存密钥池。同一时间只运行一个导入任务。
+    """
+
+    name = "导入密钥"
+
+    @property
+    def concurrency(self) -> int:
+        return config.IMPORT_CONCURRENCY
+
+    @property
+    def batch_size(self) -> int:
+        return config.IMPORT_BATCH_SIZE
+
+    def start(self, parser: KeyParser):
+        """用解析结果启动导入任务，已有任务在运行时不启动并返回None"""
+        if self.running:
+            return None
+        return self._launch(
+            ImportJob(parser.close(), parser.invalid_format, parser.duplicate)
+        )
+
+    async def process(self, job: ImportJob, key: str):
+        valid, balance = await validate_key_async(key)
+        if not valid:
+            job.invalid += 1
+            return None
+        if float(balance) <= 0:
+            job.zero_balance += 1
+        now = time.time()
+        return key, now, balance, now
+
+    async def write(self, job: ImportJob, batch: list):
+        def apply(conn):
+            conn.executemany(
+                "INSERT OR IGNORE INTO api_keys (key, add_time, balance, usage_count, enabled, last_checked) VALUES (?, ?, ?, 0, 1, ?)",
+                batch,
+            )
+
+        await database.write(apply)
+        # 提交成功后才加入内存密钥池，保证二者一致
+        for key, add_time, balance, _ in batch:
+            key_pool.add(key, balance, add_time)
+        job.imported += len(batch)
+
+    def summary(self, job: ImportJob) -> str:
+        message = f"导入成功 {job.imported} 个"
+        if job.zero_balance > 0:
+            message += f"（其中 {job.zero_balance} 个余额用尽，可用于免费模型）"
+        message += f"，有重复 {job.duplicate} 个，格式无效 {job.invalid_format} 个，API 验证失败 {job.invalid} 个"
+        return message
+
+
+# 全局密钥导入器
+key_importer = KeyImporter()
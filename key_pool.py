@@ -0,0 +1,385 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from circuit_breaker import circuit_breakers
+from db import connect
+from rate_limit import rate_limiter
+
+# 各选择策略对应的排序字段以及方向（1 表示取最小值，-1 表示取最大值）
+STRATEGY_INDEXES = {
+    "high": ("balance", -1),
+    "low": ("balance", 1),
+    "least_used": ("usage_count", 1),
+    "most_used": ("usage_count", -1),
+    "oldest": ("add_time", 1),
+    "newest": ("add_time", -1),
+}
+
+# 随机策略在放弃抽样、退化为线性扫描前的最大尝试次数
+RANDOM_PROBES = 16
+
+
+class KeyRecord:
+    """内存中的单个API密钥记录"""
+
+    __slots__ = ("key", "add_time", "balance", "usage_count", "enabled", "last_checked")
+
+    def __init__(self, key, add_time, balance, usage_count, enabled, last_checked=0):
+        self.key = key
+        self.add_time = add_time
+        self.balance = balance
+        self.usage_count = usage_count
+        self.enabled = enabled
+        # 最近一次向上游核实余额的时间
+        self.last_checked = last_checked
+
+
+class _Partition:
+    """一组启用的密钥及其按策略建立的索引
+
+    随机策略使用数组 + 位置表实现 O(1) 抽取与删除；
+    其余策略各维护一个堆，采用惰性删除：每次字段变化都压入新条目，
+    旧条目通过版本号判定为失效，在弹出时丢弃。
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.positions = {}
+        self.heaps = {name: [] for name in STRATEGY_INDEXES}
+        # field -> {key: 当前有效条目的版本号}
+        self.versions = {"balance": {}, "usage_count": {}, "add_time": {}}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def add(self, record: KeyRecord):
+        if record.key in self.positions:
+            return
+        self.positions[record.key] = len(self.keys)
+        self.keys.append(record.key)
+        for field in self.versions:
+            self.reindex(record, field)
+
+    def remove(self, key: str):
+        idx = self.positions.pop(key, None)
+        if idx is None:
+            return
+        last = self.keys.pop()
+        if last != key:
+            self.keys[idx] = last
+            self.positions[last] = idx
+        for versions in self.versions.values():
+            versions.pop(key, None)
+
+    def reindex(self, record: KeyRecord, field: str):
+        """字段值变化后为该密钥压入新的堆条目"""
+        version = next(self._counter)
+        self.versions[field][record.key] = version
+        value = getattr(record, field)
+        for name, (index_field, direction) in STRATEGY_INDEXES.items():
+            if index_field != field:
+                continue
+            heap = self.heaps[name]
+            heapq.heappush(heap, (direction * value, version, record.key))
+            if len(heap) > 2 * len(self.keys) + 64:
+                self._compact(name)
+
+    def _compact(self, name: str):
+        field = STRATEGY_INDEXES[name][0]
+        versions = self.versions[field]
+        heap = [e for e in self.heaps[name] if versions.get(e[2]) == e[1]]
+        heapq.heapify(heap)
+        self.heaps[name] = heap
+
+    def pick(self, strategy: str, accept=None):
+        if not self.keys:
+            return None
+        if strategy not in STRATEGY_INDEXES:
+            return self._pick_random(accept)
+
+        heap = self.heaps[strategy]
+        versions = self.versions[STRATEGY_INDEXES[strategy][0]]
+        skipped = []
+        selected = None
+        while heap:
+            entry = heap[0]
+            if versions.get(entry[2]) != entry[1]:
+                heapq.heappop(heap)
+                continue
+            if accept is None or accept(entry[2]):
+                selected = entry[2]
+                break
+            skipped.append(heapq.heappop(heap))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return selected
+
+    def _pick_random(self, accept=None):
+        if accept is None:
+            return random.choice(self.keys)
+        for _ in range(min(RANDOM_PROBES, len(self.keys))):
+            key = random.choice(self.keys)
+            if accept(key):
+                return key
+        # 抽样失败说明大部分密钥不可用，退化为线性扫描
+        candidates = [k for k in self.keys if accept(k)]
+        return random.choice(candidates) if candidates else None
+
+
+class _CheckQueue:
+    """余额大于0的密钥按上次核实时间排序的队列，供滚动核实选择下一个key
+
+    自上次核实后被使用过的密钥放在单独的堆中，调度方可以对两个堆顶分别加权比较，
+    不必扫描整个密钥池。与 _Partition 相同采用惰性删除。
+    """
+
+    def __init__(self):
+        # 下标为是否被使用过
+        self.heaps = ([], [])
+        # key -> (是否被使用过, 当前有效条目的版本号)
+        self.entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, record: KeyRecord, used: bool = False):
+        version = next(self._counter)
+        self.entries[record.key] = (used, version)
+        heap = self.heaps[used]
+        heapq.heappush(heap, (record.last_checked or 0, version, record.key))
+        if len(heap) > 2 * len(self.entries) + 64:
+            self.heaps[used][:] = [
+                e for e in heap if self.entries.get(e[2]) == (used, e[1])
+            ]
+            heapq.heapify(self.heaps[used])
+
+    def remove(self, key: str):
+        self.entries.pop(key, None)
+
+    def mark_used(self, record: KeyRecord):
+        entry = self.entries.get(record.key)
+        if entry is not None and not entry[0]:
+            self.push(record, True)
+
+    def oldest(self, used: bool):
+        """返回 (上次核实时间, key)，堆为空时返回None"""
+        heap = self.heaps[used]
+        while heap:
+            last_checked, version, key = heap[0]
+            if self.entries.get(key) == (used, version):
+                return last_checked, key
+            heapq.heappop(heap)
+        return None
+
+
+class KeyPool:
+    """进程内的API密钥池
+
+    启动时从 pool.db 加载一次，之后由导入、启用/禁用、删除、刷新等路由同步维护，
+    转发请求时的密钥选择完全在内存中完成，不再访问 SQLite。
+    启用的密钥按余额划分为正余额与零余额两个分区。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._records = {}
+        self._positive = _Partition()
+        self._zero = _Partition()
+        self._checks = _CheckQueue()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def load(self):
+        """从数据库加载全部密钥，覆盖当前内存状态"""
+        conn = connect()
+        try:
+            rows = conn.execute(
+                "SELECT key, add_time, balance, usage_count, enabled, last_checked FROM api_keys"
+            ).fetchall()
+        finally:
+            conn.close()
+        with self._lock:
+            self._records = {}
+            self._positive = _Partition()
+            self._zero = _Partition()
+            self._checks = _CheckQueue()
+            for key, add_time, balance, usage_count, enabled, last_checked in rows:
+                self._insert(
+                    KeyRecord(
+                        key,
+                        add_time or 0,
+                        float(balance or 0),
+                        usage_count or 0,
+                        bool(enabled),
+                        last_checked or 0,
+                    )
+                )
+
+    def get(self, key: str):
+        with self._lock:
+            return self._records.get(key)
+
+    def add(self, key: str, balance: float, add_time: float = None):
+        """添加新密钥，已存在时仅更新余额"""
+        with self._lock:
+            if key in self._records:
+                self.update_balance(key, balance)
+                return
+            now = time.time()
+            self._insert(
+                KeyRecord(
+                    key,
+                    add_time if add_time is not None else now,
+                    float(balance),
+                    0,
+                    True,
+                    now,
+                )
+            )
+
+    def remove(self, key: str):
+        """移除密钥，同时丢弃它的熔断与限流状态，避免已删除的key一直占用内存"""
+        with self._lock:
+            record = self._records.pop(key, None)
+            if record:
+                self._partition_of(record).remove(key)
+                self._checks.remove(key)
+            circuit_breakers.forget(key)
+            rate_limiter.forget(key)
+
+    def remove_many(self, keys):
+        """一次性移除多个密钥，期间其他线程不会看到只移除了一部分的状态"""
+        with self._lock:
+            for key in keys:
+                self.remove(key)
+
+    def set_enabled(self, key: str, enabled: bool):
+        with self._lock:
+            record = self._records.get(key)
+            if not record or record.enabled == bool(enabled):
+                return
+            if record.enabled:
+                self._partition_of(record).remove(key)
+            record.enabled = bool(enabled)
+            if record.enabled:
+                self._partition_of(record).add(record)
+
+    def set_enabled_many(self, keys, enabled: bool):
+        with self._lock:
+            for key in keys:
+                self.set_enabled(key, enabled)
+
+    def update_balance(self, key: str, balance: float):
+        with self._lock:
+            record = self._records.get(key)
+            if not record:
+                return
+            balance = float(balance)
+            if (record.balance > 0) != (balance > 0):
+                if balance > 0:
+                    self._checks.push(record)
+                else:
+                    self._checks.remove(key)
+            if not record.enabled:
+                record.balance = balance
+                return
+            old_partition = self._partition_of(record)
+            record.balance = balance
+            new_partition = self._partition_of(record)
+            if new_partition is not old_partition:
+                old_partition.remove(key)
+                new_partition.add(record)
+            else:
+                new_partition.reindex(record, "balance")
+
+    def mark_checked(self, key: str, checked_at: float = None):
+        """记录密钥刚刚向上游核实过余额"""
+        with self._lock:
+            record = self._records.get(key)
+            if record:
+                record.last_checked = checked_at if checked_at is not None else time.time()
+                if record.balance > 0:
+                    self._checks.push(record)
+
+    def apply_checks(self, updates, removed):
+        """一次性应用一批核实结果
+
+        Args:
+            updates: (balance, checked_at, key) 列表
+            removed: 需要移除的无效密钥
+        """
+        with self._lock:
+            for balance, checked_at, key in updates:
+                self.update_balance(key, balance)
+                self.mark_checked(key, checked_at)
+            self.remove_many(removed)
+
+    def increment_usage(self, key: str, count: int = 1):
+        with self._lock:
+            record = self._records.get(key)
+            if not record:
+                return
+            record.usage_count += count
+            self._checks.mark_used(record)
+            if record.enabled:
+                self._partition_of(record).reindex(record, "usage_count")
+
+    def select(self, strategy: str, use_zero_balance: bool = False, accept=None):
+        """按策略选择一个启用的密钥
+
+        Args:
+            strategy: 选择策略，未知策略按随机处理
+            use_zero_balance: 是否从余额为0的分区中选择（此时固定使用随机策略）
+            accept: 可选的过滤函数，返回 False 的密钥会被跳过
+
+        Returns:
+            选择的API密钥，没有可用密钥时返回None
+        """
+        with self._lock:
+            if use_zero_balance:
+                return self._zero.pick("random", accept)
+            return self._positive.pick(strategy, accept)
+
+    def check_candidates(self):
+        """返回滚动核实的候选key以及余额大于0的key数量
+
+        候选为最久未核实的key和自上次核实后被使用过的key中最久未核实的一个，
+        格式为 (上次核实时间, key, 是否被使用过)。
+        """
+        with self._lock:
+            candidates = []
+            for used in (False, True):
+                oldest = self._checks.oldest(used)
+                if oldest is not None:
+                    candidates.append((*oldest, used))
+            return candidates, len(self._checks)
+
+    def snapshot(self):
+        """返回所有密钥记录的列表副本"""
+        with self._lock:
+            return list(self._records.values())
+
+    def _insert(self, record: KeyRecord):
+        self._records[record.key] = record
+        if record.balance > 0:
+            self._checks.push(record)
+        if record.enabled:
+            self._partition_of(record).add(record)
+
+    def _partition_of(self, record: KeyRecord):
+        return self._positive if record.balance > 0 else self._zero
+
+
+# 全局密钥池
+key_pool = KeyPool()
@@ -0,0 +1,114 @@
+import asyncio
+import time
+import config
+from db import database
+from key_batch import KeyBatchJob, KeyBatchRunner
+from key_pool import key_pool
+from utils import validate_key_async
+
+
+class RefreshJob(KeyBatchJob):
+    """一次批量刷新的进度"""
+
+    def __init__(self, keys: list, initial_balance: float):
+        super().__init__(keys)
+        self.initial_balance = initial_balance
+        self.updated = 0
+        self.removed = 0
+        self.zero_balance = 0
+
+    def counters(self) -> dict:
+        return {
+            "updated": self.updated,
+            "removed": self.removed,
+            "zero_balance": self.zero_balance,
+        }
+
+
+class KeyRefresher(KeyBatchRunner):
+    """批量刷新密钥余额
+
+    以固定数量的并发验证key（共享上游连接池），每得到一个结果就立即更新内存密钥池，
+    数据库按批提交。同一时间只运行一个刷新任务，重复触发时复用正在运行的任务。
+    """
+
+    name = "刷新密钥"
+
+    @property
+    def concurrency(self) -> int:
+        return config.REFRESH_CONCURRENCY
+
+    @property
+    def batch_size(self) -> int:
+        return config.REFRESH_BATCH_SIZE
+
+    def start(self) -> RefreshJob:
+        """刷新所有余额大于0的key，已有任务在运行时直接返回该任务"""
+        if self.running:
+            return self._job
+        return self._launch_for([r for r in key_pool.snapshot() if r.balance > 0])
+
+    def start_keys(self, keys: list):
+        """刷新指定的key（余额为0的也会核实），已有任务在运行时不启动并返回None"""
+        if self.running:
+            return None
+        records = [key_pool.get(key) for key in keys]
+        return self._launch_for([r for r in records if r is not None])
+
+    def _launch_for(self, records: list) -> RefreshJob:
+        return self._launch(
+            RefreshJob(
+                [r.key for r in records],
+                sum(r.balance for r in records if r.balance > 0),
+            )
+        )
+
+    async def run(self) -> RefreshJob:
+        """启动（或加入）刷新任务并等待其完成"""
+        job = self.start()
+        await asyncio.shield(self._task)
+        return job
+
+    async def process(self, job: RefreshJob, key: str):
+        valid, balance = await validate_key_async(key)
+        # 结果立即生效于内存密钥池，数据库按批写入
+        if not valid:
+            key_pool.remove(key)
+            job.removed += 1
+            return False, (key,)
+        checked_at = time.time()
+        key_pool.update_balance(key, balance)
+        key_pool.mark_checked(key, checked_at)
+        job.updated += 1
+        if float(balance) <= 0:
+            job.zero_balance += 1
+        return True, (balance, checked_at, key)
+
+    async def write(self, job: RefreshJob, batch: list):
+        updates = [row for valid, row in batch if valid]
+        deletes = [row for valid, row in batch if not valid]
+
+        def apply(conn):
+            conn.executemany(
+                "UPDATE api_keys SET balance = ?, last_checked = ? WHERE key = ?",
+                updates,
+            )
+            conn.executemany("DELETE FROM api_keys WHERE key = ?", deletes)
+
+        await database.write(apply)
+
+    def summary(self, job: RefreshJob) -> str:
+        records = [key_pool.get(key) for key in job.keys]
+        new_balance = sum(r.balance for r in records if r is not None and r.balance > 0)
+        balance_change = new_balance - job.initial_balance
+        message = f"刷新完成，更新 {job.updated} 个 Key（其中 {job.zero_balance} 个余额用尽），移除 {job.removed} 个无效的 Key"
+        if balance_change > 0:
+            message += f"，余额增加了{round(balance_change, 2)}"
+        else:
+            balance_decrease = abs(balance_change)
+            message += f"，余额减少了{round(balance_decrease, 2)}"
+        return message
+
+
+# 全局密钥刷新器
+key_refresher = KeyRefresher()
@@ -4,7 +4,11 @@ import uvicorn
 import logging
 from uvicorn.config import LOGGING_CONFIG
 from contextlib import asynccontextmanager
-from db import init_db
+import http_client
+from db import database, init_db, log_dimensions, write_buffer
+from key_pool import key_pool
+from retention import log_retention
+from revalidator import revalidator
 from routers import api_keys, generate, logs, config, static, stats, auth
 
 # 配置日志格式
@@ -27,8 +31,16 @@ logging.basicConfig(level=logging.INFO)
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    await http_client.start()
+    write_buffer.start()
+    log_retention.start()
+    revalidator.start(config.read_config().get("refresh_interval", 0))
     yield
-    config.stop_scheduler()
+    await revalidator.stop()
+    await log_retention.stop()
+    await write_buffer.close()
+    await http_client.close()
+    database.stop()
 
 
 # 创建FastAPI应用
@@ -40,6 +52,13 @@ app = FastAPI(
 
 # 初始化数据库
 init_db()
+database.start()
+
+# 加载内存密钥池
+key_pool.load()
+
+# 加载日志筛选用的模型与接口名称
+log_dimensions.load()
 
 # 挂载静态文件
 app.mount("/static", StaticFiles(directory="static"))
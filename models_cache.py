@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import logging
+import time
+import config
+
+# 后台刷新失败后，至少等待这么久（秒）再重试，期间继续返回旧数据
+REFRESH_RETRY_DELAY = 30
+
+
+class _Entry:
+    __slots__ = ("body", "etag", "fetched_at", "retry_at")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.fetched_at = time.monotonic()
+        self.retry_at = 0
+
+
+class ModelsCache:
+    """/v1/models 响应的内存缓存
+
+    按key类别（有余额的key与余额为0的key）分别缓存，两者能看到的模型列表不同。
+    缓存超过 models_cache_ttl 后仍先返回旧数据，同时在后台刷新（stale-while-revalidate）；
+    只有从未成功获取过时才需要等待上游。只缓存上游返回 200 的响应。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._refreshing = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return config.MODELS_CACHE_TTL > 0
+
+    async def get(self, key_class: str, fetch):
+        """返回 (缓存条目, None)；上游出错且没有缓存时返回 (None, 上游响应)
+
+        Args:
+            key_class: key类别，决定使用哪一份缓存
+            fetch: 协程函数，调用上游并返回 Response
+        """
+        entry = self._entries.get(key_class)
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry.fetched_at < config.MODELS_CACHE_TTL:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                if now >= entry.retry_at:
+                    self._refresh(key_class, fetch)
+            return entry, None
+
+        # 没有缓存时，同一类别的并发请求共用一次上游调用
+        self.misses += 1
+        resp = await asyncio.shield(self._refresh(key_class, fetch))
+        entry = self._entries.get(key_class)
+        if resp.status_code != 200 or entry is None:
+            return None, resp
+        return entry, None
+
+    def _refresh(self, key_class: str, fetch) -> asyncio.Task:
+        task = self._refreshing.get(key_class)
+        if task is None or task.done():
+            task = asyncio.create_task(self._fetch(key_class, fetch))
+            task.add_done_callback(_log_refresh_error)
+            self._refreshing[key_class] = task
+        return task
+
+    async def _fetch(self, key_class: str, fetch):
+        try:
+            resp = await fetch()
+        except Exception:
+            self._postpone(key_class)
+            raise
+        if resp.status_code == 200:
+            self._entries[key_class] = _Entry(resp.body)
+        else:
+            self._postpone(key_class)
+        return resp
+
+    def _postpone(self, key_class: str):
+        entry = self._entries.get(key_class)
+        if entry is not None:
+            entry.retry_at = time.monotonic() + REFRESH_RETRY_DELAY
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "entries": {
+                key_class: round(now - entry.fetched_at)
+                for key_class, entry in self._entries.items()
+            },
+        }
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logging.warning(f"刷新模型列表失败: {task.exception()}")
+    elif task.result().status_code != 200:
+        logging.warning(f"刷新模型列表失败: HTTP {task.result().status_code}")
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """判断请求头 If-None-Match 是否与当前 ETag 匹配"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # 弱比较：忽略 W/ 前缀
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+# 全局模型列表缓存
+models_cache = ModelsCache()
@@ -0,0 +1,217 @@
+import time
+import config
+
+# 429 响应没有给出 Retry-After 时的默认冷却时间（秒）
+DEFAULT_RETRY_AFTER = 10
+
+
+class TokenBucket:
+    """按分钟匀速补充的令牌桶，余量允许为负表示透支"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        refill = (now - self.updated) * self.rate
+        self.tokens = min(self.capacity, self.tokens + refill)
+        self.updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def set_limit(self, capacity: float):
+        if capacity > 0 and capacity != self.capacity:
+            self._refill()
+            self.capacity = float(capacity)
+            self.rate = self.capacity / 60
+            self.tokens = min(self.tokens, self.capacity)
+
+    def set_remaining(self, remaining: float):
+        self._refill()
+        self.tokens = min(self.capacity, float(remaining))
+
+    def drain(self, retry_after: float = None):
+        """清空令牌；给出 retry_after 时透支到恰好在该时间后恢复可用"""
+        self._refill()
+        self.tokens = 1 - retry_after * self.rate if retry_after else 0
+
+
+class _KeyModelLimits:
+    __slots__ = ("rpm", "tpm")
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = TokenBucket(rpm) if rpm > 0 else None
+        self.tpm = TokenBucket(tpm) if tpm > 0 else None
+
+
+def _header_number(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def estimate_request_tokens(body: bytes, max_tokens=None) -> int:
+    """粗略估计一次请求会消耗的token数，只用于发出前判断TPM余量
+
+    输入按请求体字节数的四分之一计，再加上请求允许的最大输出token数；
+    实际用量在响应后按上游返回的 usage 扣减。
+    """
+    tokens = len(body or b"") // 4
+    if isinstance(max_tokens, int) and not isinstance(max_tokens, bool) and max_tokens > 0:
+        tokens += max_tokens
+    return tokens
+
+
+class RateLimiter:
+    """跟踪每个key在每个模型上的RPM/TPM令牌桶
+
+    初始额度来自配置中按模型设置的限额，之后由上游返回的限流响应头和429响应校正，
+    并按已经解析出的token用量扣减。
+    """
+
+    def __init__(self):
+        # key -> {model: _KeyModelLimits}
+        self._limits = {}
+
+    @staticmethod
+    def configured_limits(model: str):
+        """返回模型配置的 (rpm, tpm)，0 表示不限制"""
+        limits = config.RATE_LIMITS.get(model)
+        if limits is None:
+            limits = config.RATE_LIMITS.get("default", {})
+        return limits.get("rpm", 0), limits.get("tpm", 0)
+
+    def _get(self, key: str, model: str) -> _KeyModelLimits:
+        models = self._limits.setdefault(key, {})
+        limits = models.get(model)
+        if limits is None:
+            limits = _KeyModelLimits(*self.configured_limits(model))
+            models[model] = limits
+        return limits
+
+    def can_accept(self, key: str, model: str, tokens: int = 0) -> bool:
+        """判断key当前能否在该模型上再承接一个请求"""
+        limits = self._limits.get(key, {}).get(model)
+        if limits is None:
+            return True
+        if limits.rpm is not None and limits.rpm.available() < 1:
+            return False
+        # 估计值超过桶容量时按容量计，否则该请求永远不会被认为有余量
+        if limits.tpm is not None and limits.tpm.available() < min(
+            max(tokens, 1), limits.tpm.capacity
+        ):
+            return False
+        return True
+
+    def acquire(self, key: str, model: str):
+        """请求发出时扣减一个请求令牌
+
+        只扣减已有的令牌桶：模型名由客户端填写，上游接受之前不为其建立状态。
+        """
+        limits = self._limits.get(key, {}).get(model)
+        if limits is not None and limits.rpm is not None:
+            limits.rpm.take(1)
+
+    def record_response(self, key: str, model: str, status: int, headers):
+        """根据上游响应校正令牌桶
+
+        只有上游接受了该模型（成功响应或429）时才建立令牌桶，
+        避免为不存在的模型名无限创建状态。
+        """
+        if status >= 400 and status != 429:
+            return
+        if model not in self._limits.get(key, {}):
+            limits = self._get(key, model)
+            # 本次请求发出时还没有令牌桶，补扣它的请求令牌
+            if limits.rpm is not None:
+                limits.rpm.take(1)
+        self.update_from_headers(key, model, headers)
+        if status == 429:
+            self.throttle(key, model, headers)
+
+    def forget(self, key: str):
+        """丢弃已移除key的全部限流状态"""
+        self._limits.pop(key, None)
+
+    def charge(self, key: str, model: str, tokens: int):
+        """按实际用量扣减token令牌"""
+        if not tokens:
+            return
+        limits = self._get(key, model)
+        if limits.tpm is not None:
+            limits.tpm.take(tokens)
+
+    def update_from_headers(self, key: str, model: str, headers):
+        """根据上游的 x-ratelimit-* 响应头校正令牌桶"""
+        limit_requests = _header_number(headers, "x-ratelimit-limit-requests")
+        remaining_requests = _header_number(
+            headers, "x-ratelimit-remaining-requests"
+        )
+        limit_tokens = _header_number(headers, "x-ratelimit-limit-tokens")
+        remaining_tokens = _header_number(headers, "x-ratelimit-remaining-tokens")
+        if (
+            limit_requests is None
+            and remaining_requests is None
+            and limit_tokens is None
+            and remaining_tokens is None
+        ):
+            return
+
+        limits = self._get(key, model)
+        if limit_requests:
+            if limits.rpm is None:
+                limits.rpm = TokenBucket(limit_requests)
+            limits.rpm.set_limit(limit_requests)
+        if remaining_requests is not None and limits.rpm is not None:
+            limits.rpm.set_remaining(remaining_requests)
+        if limit_tokens:
+            if limits.tpm is None:
+                limits.tpm = TokenBucket(limit_tokens)
+            limits.tpm.set_limit(limit_tokens)
+        if remaining_tokens is not None and limits.tpm is not None:
+            limits.tpm.set_remaining(remaining_tokens)
+
+    def throttle(self, key: str, model: str, headers=None):
+        """上游返回429时清空该key在该模型上的令牌，直到冷却结束"""
+        retry_after = _header_number(headers, "retry-after") if headers else None
+        if not retry_after:
+            retry_after = DEFAULT_RETRY_AFTER
+        limits = self._get(key, model)
+        if limits.rpm is None:
+            limits.rpm = TokenBucket(max(self.configured_limits(model)[0], 1))
+        limits.rpm.drain(retry_after)
+        if limits.tpm is not None:
+            limits.tpm.drain(retry_after)
+
+    def snapshot(self, key: str) -> dict:
+        """返回key在各模型上的生效限额和当前余量"""
+        result = {}
+        for model, limits in self._limits.get(key, {}).items():
+            info = {}
+            if limits.rpm is not None:
+                info["rpm_limit"] = limits.rpm.capacity
+                info["rpm_remaining"] = max(0, int(limits.rpm.available()))
+            if limits.tpm is not None:
+                info["tpm_limit"] = limits.tpm.capacity
+                info["tpm_remaining"] = max(0, int(limits.tpm.available()))
+            result[model] = info
+        return result
+
+
+# 全局限流跟踪器
+rate_limiter = RateLimiter()
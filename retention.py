@@ -0,0 +1,123 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime
+import config
+from db import LOG_COLUMNS, database, format_log_rows
+
+# 两次清理之间的间隔（秒）
+RETENTION_INTERVAL = 3600
+
+# 每批归档并删除的日志条数
+RETENTION_BATCH_SIZE = 5000
+
+# 每次 incremental_vacuum 回收的页数
+VACUUM_PAGES = 1000
+
+
+def _append_archive(records: list):
+    """把日志按调用时间所在月份追加到 gzip 压缩的 NDJSON 归档文件"""
+    os.makedirs(config.LOG_ARCHIVE_DIR, exist_ok=True)
+    by_month = {}
+    for record in records:
+        month = datetime.fromtimestamp(record["call_time"]).strftime("%Y-%m")
+        by_month.setdefault(month, []).append(record)
+    for month, items in by_month.items():
+        path = os.path.join(config.LOG_ARCHIVE_DIR, f"logs-{month}.ndjson.gz")
+        # 以追加方式写入新的 gzip 成员，整个文件仍可直接用 gzip 解压
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for record in items:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _incremental_vacuum(conn):
+    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+class LogRetention:
+    """按保留天数归档并删除过期日志，并在后台逐步回收数据库空间
+
+    过期日志先按月追加到归档文件，写入成功后再分批删除，每批都是一个很短的写事务；
+    删除后留下的空闲页由 incremental_vacuum 分多次回收，不会长时间占用写线程。
+    汇总统计表 log_rollups 不受影响，统计页仍然可以查看已归档时间段的数据。
+    """
+
+    def __init__(self):
+        self._task = None
+        self._vacuum_task = None
+
+    def start(self):
+        """启动定时清理任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, self._vacuum_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._vacuum_task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"日志清理失败: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    async def run_once(self):
+        """归档并删除超过保留天数的日志，然后回收空间"""
+        days = config.LOG_RETENTION_DAYS
+        if days and days > 0:
+            cutoff = int((time.time() - days * 86400) * 1000)
+            archived = await self.archive_before(cutoff)
+            if archived:
+                logging.info(f"已归档并删除 {archived} 条过期日志")
+        await self.vacuum()
+
+    async def archive_before(self, cutoff_ms: int) -> int:
+        """分批归档并删除调用时间早于 cutoff_ms 的日志，返回处理的条数"""
+        total = 0
+        while True:
+            rows = await database.fetchall(
+                f"SELECT {LOG_COLUMNS} FROM logs WHERE call_time < ? ORDER BY call_time, id LIMIT ?",
+                (cutoff_ms, RETENTION_BATCH_SIZE),
+            )
+            if not rows:
+                return total
+            # 先写归档再删除，中途失败时最多产生重复的归档记录，不会丢失日志
+            await asyncio.to_thread(_append_archive, format_log_rows(rows))
+            await database.executemany(
+                "DELETE FROM logs WHERE id = ?", [(row[8],) for row in rows]
+            )
+            total += len(rows)
+
+    def schedule_vacuum(self):
+        """在后台回收空间，已有回收任务在运行时直接复用"""
+        if self._vacuum_task is None or self._vacuum_task.done():
+            self._vacuum_task = asyncio.create_task(self.vacuum())
+        return self._vacuum_task
+
+    async def vacuum(self):
+        """分多次执行 incremental_vacuum，直到没有空闲页"""
+        free = (await database.fetchone("PRAGMA freelist_count"))[0]
+        while free:
+            remaining = await database.write(_incremental_vacuum)
+            # 数据库不是增量回收模式时空闲页不会减少
+            if remaining >= free:
+                return
+            free = remaining
+            await asyncio.sleep(0)
+
+
+# 全局日志清理任务
+log_retention = LogRetention()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import random
+import time
+import config
+from circuit_breaker import circuit_breakers
+from key_pool import key_pool
+from utils import check_and_remove_key
+
+# 自上次核实后被使用过的key，等待时间按此倍数计算优先级
+USED_PRIORITY = 2.0
+
+# 最近转发出错（熔断器记录了失败）的key的优先级倍数
+ERROR_PRIORITY = 4.0
+
+
+class Revalidator:
+    """在主事件循环中滚动核实密钥余额
+
+    不再每隔N分钟集中刷新整个密钥池，而是把一个刷新周期平摊到每个key上：
+    每次只核实优先级最高的一个key，间隔为 周期 / key数量 并加上随机抖动。
+    优先级为距上次核实的时间乘以权重，最近被使用或出错的key权重更高。
+    核实时间持久化在 api_keys.last_checked，重启后从最久未核实的key继续。
+    """
+
+    def __init__(self):
+        self._task = None
+        self._interval = 0
+        self._wakeup = asyncio.Event()
+        # 周期是否短到无法覆盖整个密钥池，只在状态变化时输出警告
+        self._undersized = False
+
+    @property
+    def interval(self) -> int:
+        return self._interval
+
+    def start(self, interval: int):
+        """启动后台任务，interval 为刷新完整个密钥池的周期（分钟），0 表示暂停"""
+        self._interval = interval
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        logging.info("API密钥滚动核实任务已启动")
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def set_interval(self, interval: int):
+        """修改刷新周期并立即按新周期重新计算等待时间"""
+        self._interval = interval
+        self._wakeup.set()
+
+    def _pick(self):
+        """返回优先级最高的key以及当前参与核实的key数量
+
+        只比较密钥池维护的两个堆顶（最久未核实、被使用过且最久未核实）
+        以及熔断器中记录了失败的少量key，不扫描整个密钥池。
+        """
+        now = time.time()
+        heads, count = key_pool.check_candidates()
+        candidates = [
+            ((now - last_checked) * (USED_PRIORITY if used else 1.0), key)
+            for last_checked, key, used in heads
+        ]
+        for key in circuit_breakers.failing():
+            record = key_pool.get(key)
+            if record is not None and record.balance > 0:
+                priority = (now - (record.last_checked or 0)) * ERROR_PRIORITY
+                candidates.append((priority, key))
+        if not candidates:
+            return None, count
+        return max(candidates)[1], count
+
+    async def run_once(self):
+        """核实一个key，返回参与核实的key数量"""
+        key, count = self._pick()
+        if key is None:
+            return 0
+        await check_and_remove_key(key)
+        return count
+
+    def _delay(self, count: int) -> float:
+        if self._interval <= 0:
+            return None
+        delay = self._interval * 60 / max(count, 1)
+        undersized = delay < config.REVALIDATE_MIN_DELAY
+        if undersized and not self._undersized:
+            minutes = count * config.REVALIDATE_MIN_DELAY / 60
+            logging.warning(
+                f"刷新周期 {self._interval} 分钟内无法核实全部 {count} 个key："
+                f"每个key至少间隔 {config.REVALIDATE_MIN_DELAY} 秒，核实一轮约需 {minutes:.1f} 分钟"
+            )
+        self._undersized = undersized
+        jitter = config.REVALIDATE_JITTER
+        delay *= random.uniform(1 - jitter, 1 + jitter)
+        return max(delay, config.REVALIDATE_MIN_DELAY)
+
+    async def _run(self):
+        count = 0
+        while True:
+            self._wakeup.clear()
+            if self._interval > 0:
+                try:
+                    count = await self.run_once()
+                except Exception as e:
+                    logging.error(f"滚动核实API密钥失败: {e}")
+            delay = self._delay(count)
+            try:
+                # 周期为0时一直等到重新设置周期
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+# 全局滚动核实任务
+revalidator = Revalidator()
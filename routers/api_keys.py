@@ -1,19 +1,34 @@
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse, Response
-import asyncio
-from db import conn, cursor
-from utils import validate_key_async, validate_key_format, clean_key
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import codecs
+import json
+import time
+from circuit_breaker import circuit_breakers
+from db import database
+from key_import import KeyParser, key_importer
+from key_pool import key_pool
+from key_refresh import key_refresher
+from rate_limit import rate_limiter
+from utils import (
+    validate_key_async,
+    clamp_page_size,
+    decode_cursor,
+    encode_cursor,
+)
 
 router = APIRouter()
 
 
 @router.get("/api/keys")
 async def get_keys(
-    page: int = 1,
+    cursor: str = None,
+    page_size: int = 10,
     sort_field: str = "add_time",
     sort_order: str = "desc",
     balance_filter: str = "all",
+    with_total: bool = True,
 ):
+    """按排序字段分页获取密钥，使用 (排序字段值, key) 作为游标翻页"""
     allowed_fields = ["add_time", "balance", "usage_count", "enabled", "key"]
     allowed_orders = ["asc", "desc"]
     allowed_filters = ["all", "positive", "zero"]
@@ -25,27 +40,50 @@ async def get_keys(
     if balance_filter not in allowed_filters:
         balance_filter = "all"
 
-    page_size = 10
-    offset = (page - 1) * page_size
+    page_size = clamp_page_size(page_size)
 
     # 根据余额筛选条件构建 SQL WHERE 子句
-    filter_clause = ""
+    conditions = []
+    params = []
     if balance_filter == "positive":
-        filter_clause = "WHERE balance > 0"
+        conditions.append("balance > 0")
     elif balance_filter == "zero":
-        filter_clause = "WHERE balance <= 0"
-
-    # 计算总数
-    count_sql = f"SELECT COUNT(*) FROM api_keys {filter_clause}"
-    cursor.execute(count_sql)
-    total = cursor.fetchone()[0]
-
-    # 获取分页数据
-    cursor.execute(
-        f"SELECT key, add_time, balance, usage_count, enabled FROM api_keys {filter_clause} ORDER BY {sort_field} {sort_order} LIMIT ? OFFSET ?",
-        (page_size, offset),
+        conditions.append("balance <= 0")
+
+    # 以 key 作为排序字段相同时的次序，保证游标位置唯一
+    comparison = "<" if sort_order == "desc" else ">"
+    if cursor:
+        position = decode_cursor(cursor, 2)
+        if position is None:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+        conditions.append(f"({sort_field}, key) {comparison} (?, ?)")
+        params.extend(position)
+
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # 获取分页数据，多取一条用于判断是否还有下一页
+    keys = await database.fetchall(
+        f"SELECT key, add_time, balance, usage_count, enabled FROM api_keys {where_clause} ORDER BY {sort_field} {sort_order}, key {sort_order} LIMIT ?",
+        params + [page_size + 1],
     )
-    keys = cursor.fetchall()
+    next_cursor = None
+    if len(keys) > page_size:
+        keys = keys[:page_size]
+        last = keys[-1]
+        columns = ["key", "add_time", "balance", "usage_count", "enabled"]
+        sort_value = last[columns.index(sort_field)]
+        next_cursor = encode_cursor([sort_value, last[0]])
+
+    # 总数从内存密钥池中统计，余额为估算值，因此只是近似值
+    total = None
+    if with_total:
+        records = key_pool.snapshot()
+        if balance_filter == "positive":
+            total = sum(1 for r in records if r.balance > 0)
+        elif balance_filter == "zero":
+            total = sum(1 for r in records if r.balance <= 0)
+        else:
+            total = len(records)
 
     # Format keys as list of dicts
     key_list = [
@@ -55,12 +93,19 @@ async def get_keys(
             "balance": row[2],
             "usage_count": row[3],
             "enabled": bool(row[4]),
+            "rate_limits": rate_limiter.snapshot(row[0]),
+            "breaker": circuit_breakers.snapshot(row[0]),
         }
         for row in keys
     ]
 
     return JSONResponse(
-        {"keys": key_list, "total": total, "page": page, "page_size": page_size}
+        {
+            "keys": key_list,
+            "total": total,
+            "next_cursor": next_cursor,
+            "page_size": page_size,
+        }
     )
 
 
@@ -76,14 +121,17 @@ async def refresh_single_key(request: Request):
         valid, balance = await validate_key_async(key)
 
         if valid and float(balance) > 0:
-            cursor.execute(
-                "UPDATE api_keys SET balance = ? WHERE key = ?", (balance, key)
+            checked_at = time.time()
+            await database.execute(
+                "UPDATE api_keys SET balance = ?, last_checked = ? WHERE key = ?",
+                (balance, checked_at, key),
             )
-            conn.commit()
+            key_pool.update_balance(key, balance)
+            key_pool.mark_checked(key, checked_at)
             return JSONResponse({"message": f"密钥更新成功，当前余额: ¥{balance}"})
         else:
-            cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-            conn.commit()
+            await database.execute("DELETE FROM api_keys WHERE key = ?", (key,))
+            key_pool.remove(key)
             return JSONResponse({"message": "密钥已失效或余额为0，已从池中移除"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"刷新密钥失败: {str(e)}")
@@ -98,8 +146,8 @@ async def delete_key(request: Request):
         raise HTTPException(status_code=400, detail="未提供API密钥")
 
     try:
-        cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-        conn.commit()
+        await database.execute("DELETE FROM api_keys WHERE key = ?", (key,))
+        key_pool.remove(key)
         return JSONResponse({"message": "密钥已成功删除"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除密钥失败: {str(e)}")
@@ -118,122 +166,194 @@ async def toggle_key(request: Request):
         raise HTTPException(status_code=400, detail="未提供启用状态")
 
     try:
-        cursor.execute(
+        await database.execute(
             "UPDATE api_keys SET enabled = ? WHERE key = ?", (1 if enabled else 0, key)
         )
-        conn.commit()
+        key_pool.set_enabled(key, enabled)
         status = "启用" if enabled else "禁用"
         return JSONResponse({"message": f"密钥已成功{status}"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新密钥状态失败: {str(e)}")
 
 
-@router.post("/import_keys")
-async def import_keys(request: Request):
-    data = await request.json()
-    keys_text = data.get("keys", "")
+# 批量操作的过滤条件：字段 -> (KeyRecord 属性, 比较方式)
+BULK_FILTERS = {
+    "min_balance": ("balance", lambda value, bound: value >= bound),
+    "max_balance": ("balance", lambda value, bound: value <= bound),
+    "min_usage": ("usage_count", lambda value, bound: value >= bound),
+    "max_usage": ("usage_count", lambda value, bound: value <= bound),
+    "added_before": ("add_time", lambda value, bound: value < bound),
+}
+
+
+def _bulk_targets(data: dict) -> list:
+    """根据请求中的 keys 列表或 filter 条件确定批量操作的目标密钥
+
+    filter 支持 min_balance、max_balance、min_usage、max_usage、
+    added_before（Unix 时间戳，秒）以及 enabled（布尔值）。
+    """
+    keys = data.get("keys")
+    conditions = data.get("filter")
+    if keys is not None:
+        if not isinstance(keys, list):
+            raise HTTPException(status_code=400, detail="keys 必须是列表")
+        keys = dict.fromkeys(k for k in keys if isinstance(k, str))
+        return [key for key in keys if key in key_pool]
+    if not isinstance(conditions, dict) or not conditions:
+        raise HTTPException(status_code=400, detail="未提供API密钥列表或过滤条件")
+
+    checks = []
+    for name, bound in conditions.items():
+        if name == "enabled":
+            # 不做真值转换："false"、0.0 之类的值与客户端的本意不符，批量删除时尤其危险
+            if not isinstance(bound, bool):
+                raise HTTPException(status_code=400, detail="过滤条件 enabled 必须是布尔值")
+            checks.append(lambda r, bound=bound: r.enabled == bound)
+            continue
+        if name not in BULK_FILTERS:
+            raise HTTPException(status_code=400, detail=f"不支持的过滤条件: {name}")
+        try:
+            if isinstance(bound, bool):
+                raise TypeError
+            bound = float(bound)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"过滤条件 {name} 必须是数字")
+        field, compare = BULK_FILTERS[name]
+        checks.append(
+            lambda r, field=field, compare=compare, bound=bound: compare(
+                getattr(r, field), bound
+            )
+        )
+    return [r.key for r in key_pool.snapshot() if all(check(r) for check in checks)]
+
 
-    # 清理和验证密钥
-    raw_keys = [k.strip() for k in keys_text.splitlines() if k.strip()]
-    cleaned_keys = [clean_key(k) for k in raw_keys]
-    keys = [k for k in cleaned_keys if validate_key_format(k)]
+@router.post("/api/refresh_keys")
+async def refresh_keys_bulk(request: Request):
+    """在后台批量核实密钥余额，无效的key会被移除，进度通过 /refresh/progress 获取"""
+    keys = _bulk_targets(await request.json())
+    if not keys:
+        return JSONResponse({"message": "没有符合条件的密钥", "matched": 0})
+
+    job = key_refresher.start_keys(keys)
+    if job is None:
+        return JSONResponse({"message": "已有刷新任务正在进行，请稍候"}, status_code=409)
+    return JSONResponse(
+        {
+            "message": f"正在刷新 {job.total} 个密钥",
+            "matched": len(keys),
+            "progress": job.snapshot(),
+        }
+    )
 
-    invalid_format_count = len(raw_keys) - len(keys)
 
+@router.post("/api/delete_keys")
+async def delete_keys(request: Request):
+    keys = _bulk_targets(await request.json())
     if not keys:
-        return JSONResponse({"message": "未提供有效的 API Key"}, status_code=400)
+        return JSONResponse({"message": "没有符合条件的密钥", "matched": 0})
 
-    tasks = []
-    # 准备任务：对于重复的密钥，添加一个返回标记的虚拟任务
-    for key in keys:
-        cursor.execute("SELECT key FROM api_keys WHERE key = ?", (key,))
-        if cursor.fetchone():
-            tasks.append(asyncio.sleep(0, result=("duplicate", key)))
-        else:
-            tasks.append(validate_key_async(key))
+    try:
+        await database.executemany(
+            "DELETE FROM api_keys WHERE key = ?", [(key,) for key in keys]
+        )
+        key_pool.remove_many(keys)
+        return JSONResponse(
+            {"message": f"已成功删除 {len(keys)} 个密钥", "matched": len(keys)}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"删除密钥失败: {str(e)}")
 
-    results = await asyncio.gather(*tasks)
-    imported_count = 0
-    duplicate_count = 0
-    invalid_count = 0
-    zero_balance_count = 0
 
-    for idx, result in enumerate(results):
-        if result[0] == "duplicate":
-            duplicate_count += 1
-        else:
-            valid, balance = result
-            if valid:
-                from db import insert_api_key
+@router.post("/api/toggle_keys")
+async def toggle_keys(request: Request):
+    data = await request.json()
+    enabled = data.get("enabled")
 
-                insert_api_key(keys[idx], balance)
-                imported_count += 1
-                if float(balance) <= 0:
-                    zero_balance_count += 1
-            else:
-                invalid_count += 1
+    if enabled is None:
+        raise HTTPException(status_code=400, detail="未提供启用状态")
+    # 与过滤条件一样不做真值转换，"false"、"0" 等值直接拒绝
+    if not isinstance(enabled, bool):
+        raise HTTPException(status_code=400, detail="启用状态必须是布尔值")
+
+    keys = _bulk_targets(data)
+    if not keys:
+        return JSONResponse({"message": "没有符合条件的密钥", "matched": 0})
 
-    message = f"导入成功 {imported_count} 个"
-    if zero_balance_count > 0:
-        message += f"（其中 {zero_balance_count} 个余额用尽，可用于免费模型）"
-    message += f"，有重复 {duplicate_count} 个，格式无效 {invalid_format_count} 个，API 验证失败 {invalid_count} 个"
+    try:
+        await database.executemany(
+            "UPDATE api_keys SET enabled = ? WHERE key = ?",
+            [(1 if enabled else 0, key) for key in keys],
+        )
+        key_pool.set_enabled_many(keys, enabled)
+        status = "启用" if enabled else "禁用"
+        return JSONResponse(
+            {"message": f"已成功{status} {len(keys)} 个密钥", "matched": len(keys)}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"更新密钥状态失败: {str(e)}")
 
-    return JSONResponse({"message": message})
+
+@router.post("/import_keys")
+async def import_keys(request: Request):
+    """在后台导入密钥，进度通过 /import_keys/progress 获取
+
+    请求体为 JSON（{"keys": "..."}）或直接上传的文本文件，每行一个 Key。
+    """
+    if key_importer.running:
+        return JSONResponse({"message": "已有导入任务正在进行，请稍候"}, status_code=409)
+
+    parser = KeyParser()
+    if request.headers.get("content-type", "").startswith("application/json"):
+        data = await request.json()
+        parser.feed(data.get("keys", ""))
+    else:
+        # 上传的文件按块解析，不把整个文件读入内存
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        async for chunk in request.stream():
+            parser.feed(decoder.decode(chunk))
+        parser.feed(decoder.decode(b"", final=True))
+
+    if not parser.keys and not parser.duplicate:
+        return JSONResponse({"message": "未提供有效的 API Key"}, status_code=400)
+
+    # 读取请求体期间可能有其他导入任务已经启动
+    job = key_importer.start(parser)
+    if job is None:
+        return JSONResponse({"message": "已有导入任务正在进行，请稍候"}, status_code=409)
+    return JSONResponse(
+        {"message": f"正在导入 {job.total} 个 Key", "progress": job.snapshot()}
+    )
+
+
+@router.get("/import_keys/progress")
+async def import_progress():
+    """以 SSE 推送当前导入任务的进度，任务结束后关闭连接"""
+
+    async def generate():
+        async for snapshot in key_importer.progress():
+            yield f"data: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
 
 
 @router.post("/refresh")
 async def refresh_keys():
-    # 创建新的游标避免递归使用
-    local_cursor = conn.cursor()
+    """在后台刷新所有余额大于0的key，进度通过 /refresh/progress 获取"""
+    job = key_refresher.start()
+    return JSONResponse(
+        {"message": f"正在刷新 {job.total} 个 Key", "progress": job.snapshot()}
+    )
 
-    try:
-        # 在获取待筛选的key时仅获取余额大于0的key
-        local_cursor.execute("SELECT key, balance FROM api_keys WHERE balance > 0")
-        key_balance_map = {row[0]: row[1] for row in local_cursor.fetchall()}
-        all_keys = list(key_balance_map.keys())
-
-        # 获取初始总余额
-        initial_balance = sum(key_balance_map.values())
-
-        # 创建并行验证任务
-        tasks = [validate_key_async(key) for key in all_keys]
-        results = await asyncio.gather(*tasks)
-
-        removed = 0
-        updated = 0
-        zero_balance = 0
-        for key, (valid, balance) in zip(all_keys, results):
-            if valid:
-                local_cursor.execute(
-                    "UPDATE api_keys SET balance = ? WHERE key = ?", (balance, key)
-                )
-                updated += 1
-                if float(balance) <= 0:
-                    zero_balance += 1
-            else:
-                local_cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-                removed += 1
-
-        conn.commit()
-
-        # 计算新的总余额
-        local_cursor.execute(
-            "SELECT COALESCE(SUM(balance), 0) FROM api_keys WHERE balance > 0"
-        )
-        new_balance = local_cursor.fetchone()[0]
-        balance_change = new_balance - initial_balance
 
-        message = f"刷新完成，更新 {updated} 个 Key（其中 {zero_balance} 个余额用尽），移除 {removed} 个无效的 Key"
-        if balance_change > 0:
-            message += f"，余额增加了{round(balance_change, 2)}"
-        else:
-            balance_decrease = abs(balance_change)
-            message += f"，余额减少了{round(balance_decrease, 2)}"
+@router.get("/refresh/progress")
+async def refresh_progress():
+    """以 SSE 推送当前刷新任务的进度，任务结束后关闭连接"""
+
+    async def generate():
+        async for snapshot in key_refresher.progress():
+            yield f"data: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
 
-        return JSONResponse({"message": message})
-    finally:
-        # 确保游标被关闭
-        local_cursor.close()
+    return StreamingResponse(generate(), media_type="text/event-stream")
 
 
 @router.get("/export_keys")
@@ -259,8 +379,9 @@ async def export_keys(
         filter_sql = "WHERE balance <= 0"
 
     # 执行查询
-    cursor.execute(f"SELECT key, balance FROM api_keys {filter_sql} {sort_sql}")
-    all_keys = cursor.fetchall()
+    all_keys = await database.fetchall(
+        f"SELECT key, balance FROM api_keys {filter_sql} {sort_sql}"
+    )
 
     # 根据格式生成导出内容
     content = ""
@@ -278,14 +399,14 @@ async def export_keys(
 @router.get("/stats")
 async def stats():
     # Get count and total balance of keys with positive balance
-    cursor.execute(
+    positive_count, total_balance = await database.fetchone(
         "SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM api_keys WHERE balance > 0"
     )
-    positive_count, total_balance = cursor.fetchone()
 
     # Get count of keys with zero balance
-    cursor.execute("SELECT COUNT(*) FROM api_keys WHERE balance <= 0")
-    zero_balance_count = cursor.fetchone()[0]
+    zero_balance_count = (
+        await database.fetchone("SELECT COUNT(*) FROM api_keys WHERE balance <= 0")
+    )[0]
 
     # Get total key count
     total_key_count = positive_count + zero_balance_count
@@ -19,14 +19,14 @@ async def login(request: Request):
 
     if username == config.ADMIN_USERNAME and password == config.ADMIN_PASSWORD:
         # 清理过期会话
-        db.cleanup_expired_sessions()
+        await db.cleanup_expired_sessions()
 
         # 生成会话令牌
         session_token = secrets.token_urlsafe(32)
         expiry_time = time.time() + SESSION_EXPIRY
 
         # 将会话存储到数据库
-        db.create_session(session_token, expiry_time)
+        await db.create_session(session_token, expiry_time)
 
         # 设置响应和Cookie
         response = JSONResponse({"status": "success", "message": "登录成功"})
@@ -48,7 +48,7 @@ async def logout(request: Request):
 
     if session_token:
         # 从数据库中删除会话
-        db.delete_session(session_token)
+        await db.delete_session(session_token)
 
     response = JSONResponse({"status": "success", "message": "已退出登录"})
     response.delete_cookie(key="session_token")
@@ -63,7 +63,7 @@ async def check_auth(request: Request):
         return JSONResponse({"authenticated": False})
 
     # 从数据库查询会话
-    expiry_time = db.get_session(session_token)
+    expiry_time = await db.get_session(session_token)
 
     if not expiry_time:
         return JSONResponse({"authenticated": False})
@@ -73,12 +73,12 @@ async def check_auth(request: Request):
     # 检查会话是否过期
     if expiry_time < current_time:
         # 删除过期会话
-        db.delete_session(session_token)
+        await db.delete_session(session_token)
         return JSONResponse({"authenticated": False})
 
     # 更新会话过期时间
     new_expiry_time = current_time + SESSION_EXPIRY
-    db.update_session_expiry(session_token, new_expiry_time)
+    await db.update_session_expiry(session_token, new_expiry_time)
 
     return JSONResponse({"authenticated": True})
 
@@ -86,7 +86,7 @@ async def check_auth(request: Request):
 @router.post("/api/update_credentials")
 async def update_credentials(request: Request):
     # 先验证当前会话
-    if not validate_session(request):
+    if not await validate_session(request):
         raise HTTPException(status_code=401, detail="未认证")
 
     data = await request.json()
@@ -104,7 +104,7 @@ async def update_credentials(request: Request):
     return JSONResponse({"status": "success", "message": "管理员凭据已更新"})
 
 
-def validate_session(request: Request):
+async def validate_session(request: Request):
     """验证会话有效性的辅助函数"""
     session_token = request.cookies.get("session_token")
 
@@ -112,7 +112,7 @@ def validate_session(request: Request):
         return False
 
     # 从数据库查询会话
-    expiry_time = db.get_session(session_token)
+    expiry_time = await db.get_session(session_token)
 
     if not expiry_time:
         return False
@@ -122,11 +122,11 @@ def validate_session(request: Request):
     # 检查是否过期
     if expiry_time < current_time:
         # 删除过期会话
-        db.delete_session(session_token)
+        await db.delete_session(session_token)
         return False
 
     # 更新会话过期时间
     new_expiry_time = current_time + SESSION_EXPIRY
-    db.update_session_expiry(session_token, new_expiry_time)
+    await db.update_session_expiry(session_token, new_expiry_time)
 
     return True
@@ -3,22 +3,18 @@ from fastapi.responses import JSONResponse
 import json
 from pathlib import Path
 from typing import Dict, Any
-import threading
-import asyncio
 import logging
-from routers.api_keys import refresh_keys
+from revalidator import revalidator
 
 router = APIRouter()
 config_file = Path("config.json")
-scheduler_thread = None
-stop_event = threading.Event()
 
 # 初始化配置
 default_config = {
     "call_strategy": "random",
     "custom_api_key": "",
     "free_model_api_key": "",
-    "refresh_interval": 0,  # 单位: 分钟，0表示不自动刷新
+    "refresh_interval": 0,  # 单位: 分钟，滚动核实完整个密钥池的周期，0表示不自动刷新
 }
 
 # 确保配置文件存在
@@ -51,59 +47,6 @@ def write_config(config: Dict[str, Any]):
         logging.error(f"写入配置文件失败: {str(e)}")
 
 
-# 刷新定时任务函数
-async def refresh_task():
-    while not stop_event.is_set():
-        config = read_config()
-        interval = config.get("refresh_interval", 0)
-
-        if interval > 0:
-            try:
-                logging.debug("执行自动刷新API密钥任务")
-                await refresh_keys()
-                logging.debug(f"自动刷新API密钥任务完成，等待{interval}分钟后再次执行")
-            except Exception as e:
-                logging.error(f"自动刷新API密钥任务失败: {str(e)}")
-                
-            for _ in range(interval * 60):  # 将分钟转换为秒
-                if stop_event.is_set():
-                    break
-                await asyncio.sleep(1)
-        else:
-            # 如果间隔为0，则休眠一段时间后再次检查配置
-            await asyncio.sleep(60)
-
-
-# 启动定时任务
-def start_scheduler():
-    global scheduler_thread, stop_event
-    if scheduler_thread and scheduler_thread.is_alive():
-        return
-
-    stop_event.clear()
-
-    def run_async_task():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(refresh_task())
-
-    scheduler_thread = threading.Thread(target=run_async_task)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
-    logging.info("API密钥自动刷新任务已启动")
-
-
-# 停止定时任务
-def stop_scheduler():
-    global stop_event
-    stop_event.set()
-    logging.info("API密钥自动刷新任务已停止")
-
-
-# 在应用启动时启动定时任务
-start_scheduler()
-
-
 @router.get("/config/strategy")
 async def get_strategy():
     config = read_config()
@@ -195,10 +138,9 @@ async def update_refresh_interval(request: Request):
     config["refresh_interval"] = interval
     write_config(config)
 
-    # 更新后重启定时任务
-    stop_scheduler()
+    # 滚动核实任务按新的周期继续
+    revalidator.set_interval(interval)
     if interval > 0:
-        start_scheduler()
         return JSONResponse({"message": f"自动刷新间隔已设置为 {interval} 分钟"})
     else:
         return JSONResponse({"message": "已关闭自动刷新"})
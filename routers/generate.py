@@ -1,21 +1,105 @@
-from fastapi import APIRouter, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from starlette.requests import ClientDisconnect
 import config
 import json
 import time
-import aiohttp
-from db import conn, cursor, log_completion
-from utils import select_api_key, check_and_remove_key
+from balance_tracker import balance_tracker
+from circuit_breaker import circuit_breakers
+from db import log_completion
+from embedding_batcher import batch_group, embedding_batcher
+from embedding_cache import embedding_cache, split_inputs
+from fanout import chunked, fan_out, merge_embeddings, merge_rerank
+from forwarder import forward_request, NoAvailableKeyError
+from models_cache import etag_matches, models_cache
+from rate_limit import estimate_request_tokens, rate_limiter
+from singleflight import single_flight
+from sse import SSEUsageParser, ensure_stream_usage
 
 router = APIRouter()
 
-# API基础URL
-BASE_URL = "https://api.siliconflow.cn"
+
+async def _dispatch(
+    path: str,
+    headers: dict,
+    body: bytes,
+    timeout: float,
+    use_zero_balance: bool = False,
+    count_usage: bool = True,
+    method: str = "POST",
+    model: str = None,
+    in_use: set = None,
+    max_tokens=None,
+):
+    """通过重试引擎转发请求，将选key失败和连接失败转换为HTTP错误
+
+    max_tokens 为请求允许的最大输出token数，与请求体大小一起估计TPM消耗。
+    """
+    try:
+        return await forward_request(
+            method,
+            path,
+            headers,
+            body,
+            timeout,
+            use_zero_balance=use_zero_balance,
+            count_usage=count_usage,
+            model=model,
+            in_use=in_use,
+            tokens=estimate_request_tokens(body, max_tokens) if model else 0,
+        )
+    except NoAvailableKeyError:
+        if use_zero_balance:
+            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
+        else:
+            raise HTTPException(status_code=500, detail="没有可用的api-key")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+
+
+async def _record_call(
+    selected: str,
+    model: str,
+    call_time: float,
+    prompt_tokens: int,
+    completion_tokens: int,
+    total_tokens: int,
+    endpoint: str,
+    tried: list,
+):
+    """记录调用日志，按实际用量扣减该key的TPM令牌和估算余额"""
+    rate_limiter.charge(selected, model, total_tokens)
+    balance_tracker.record_usage(selected, model, prompt_tokens, completion_tokens)
+    await log_completion(
+        selected,
+        model,
+        call_time,
+        prompt_tokens,
+        completion_tokens,
+        total_tokens,
+        endpoint,
+        tried,
+    )
+
+
+async def _read_json(resp, selected: str):
+    """读取上游响应体，读取失败（超时、连接中断等）计入该key的熔断器"""
+    try:
+        return await resp.json()
+    except Exception:
+        circuit_breakers.record_failure(selected)
+        raise
+
+
+def _stream_media_type(resp) -> str:
+    """上游成功时按SSE返回，出错时沿用上游的内容类型"""
+    if resp.status == 200:
+        return "text/event-stream"
+    return resp.content_type or "application/json"
 
 
 @router.post("/v1/chat/completions")
-async def chat_completions(request: Request, background_tasks: BackgroundTasks):
+async def chat_completions(request: Request):
     # 检查是否应该使用余额为0的key
     use_zero_balance = False
     if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
@@ -29,27 +113,7 @@ async def chat_completions(request: Request, background_tasks: BackgroundTasks):
         if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
             raise HTTPException(status_code=403, detail="无效的API_KEY")
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
-    )
-    conn.commit()
-
-    # 使用选定的key转发请求到BASE_URL
     forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
 
     try:
         req_body = await request.body()
@@ -61,99 +125,86 @@ async def chat_completions(request: Request, background_tasks: BackgroundTasks):
     call_time_stamp = time.time()
     is_stream = req_json.get("stream", False)
 
+    # 请求上游在流的末尾返回用量，保证计费准确
+    if is_stream and config.STREAM_INCLUDE_USAGE and ensure_stream_usage(req_json):
+        req_body = json.dumps(req_json).encode("utf-8")
+
+    # 使用选定的key转发请求，失败时自动换key重试
+    resp, selected, tried = await _dispatch(
+        "/v1/chat/completions",
+        forward_headers,
+        req_body,
+        1800,
+        use_zero_balance,
+        model=model,
+        max_tokens=req_json.get("max_tokens"),
+    )
+
     if is_stream:
 
         async def generate_stream():
-            completion_tokens = 0
-            prompt_tokens = 0
-            total_tokens = 0
+            usage_parser = SSEUsageParser()
 
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{BASE_URL}/v1/chat/completions",
-                        headers=forward_headers,
-                        data=req_body,
-                        timeout=1800,
-                    ) as resp:
-                        async for chunk in resp.content.iter_any():
-                            try:
-                                chunk_str = chunk.decode("utf-8")
-                                if chunk_str == "[DONE]":
-                                    continue
-                                if chunk_str.startswith("data: "):
-                                    data = json.loads(chunk_str[6:])
-                                    usage = data.get("usage", {})
-                                    prompt_tokens = usage.get("prompt_tokens", 0)
-                                    completion_tokens = usage.get(
-                                        "completion_tokens", 0
-                                    )
-                                    total_tokens = usage.get("total_tokens", 0)
-                            except Exception:
-                                pass
-                            yield chunk
+                async with resp:
+                    async for chunk in resp.content.iter_any():
+                        usage_parser.feed(chunk)
+                        yield chunk
+                usage_parser.close()
 
                 # 流结束后记录完整token数量
-                log_completion(
+                await _record_call(
                     selected,
                     model,
                     call_time_stamp,
-                    prompt_tokens,
-                    completion_tokens,
-                    total_tokens,
+                    usage_parser.prompt_tokens,
+                    usage_parser.completion_tokens,
+                    usage_parser.total_tokens,
                     "chat_completions",
+                    tried,
                 )
-                await check_and_remove_key(selected)
 
             except Exception as e:
-                error_json = json.dumps({"error": f"请求失败: {str(e)}"}).encode(
-                    "utf-8"
-                )
+                # 流中途失败同样计入该key的熔断器
+                circuit_breakers.record_failure(selected)
+                error_json = json.dumps({"error": f"请求失败: {str(e)}"})
                 yield f"data: {error_json}\n\n".encode("utf-8")
                 yield b"data: [DONE]\n\n"
 
-        try:
-            return StreamingResponse(
-                generate_stream(),
-                headers={"Content-Type": "application/octet-stream"},
-            )
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+        return StreamingResponse(
+            generate_stream(),
+            status_code=resp.status,
+            media_type=_stream_media_type(resp),
+            headers={"Cache-Control": "no-cache"},
+        )
     else:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{BASE_URL}/v1/chat/completions",
-                    headers=forward_headers,
-                    data=req_body,
-                    timeout=1800,
-                ) as resp:
-                    resp_json = await resp.json()
-                    usage = resp_json.get("usage", {})
-                    prompt_tokens = usage.get("prompt_tokens", 0)
-                    completion_tokens = usage.get("completion_tokens", 0)
-                    total_tokens = usage.get("total_tokens", 0)
-
-                    # 记录完成调用
-                    log_completion(
-                        selected,
-                        model,
-                        call_time_stamp,
-                        prompt_tokens,
-                        completion_tokens,
-                        total_tokens,
-                        "chat_completions",
-                    )
-
-                    # 后台检查key余额
-                    background_tasks.add_task(check_and_remove_key, selected)
-                    return JSONResponse(content=resp_json, status_code=resp.status)
+            async with resp:
+                resp_json = await _read_json(resp, selected)
+                usage = resp_json.get("usage", {})
+                prompt_tokens = usage.get("prompt_tokens", 0)
+                completion_tokens = usage.get("completion_tokens", 0)
+                total_tokens = usage.get("total_tokens", 0)
+
+                # 记录完成调用
+                await _record_call(
+                    selected,
+                    model,
+                    call_time_stamp,
+                    prompt_tokens,
+                    completion_tokens,
+                    total_tokens,
+                    "chat_completions",
+                    tried,
+                )
+
+                return JSONResponse(content=resp_json, status_code=resp.status)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
 
 
 @router.post("/v1/embeddings")
-async def embeddings(request: Request, background_tasks: BackgroundTasks):
+async def embeddings(request: Request):
     # 检查是否应该使用余额为0的key
     use_zero_balance = False
     if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
@@ -167,39 +218,37 @@ async def embeddings(request: Request, background_tasks: BackgroundTasks):
         if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
             raise HTTPException(status_code=403, detail="无效的API_KEY")
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
-
     forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
+    req_body = await request.body()
+    req_json = await request.json()
+    model = req_json.get("model", "unknown")
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{BASE_URL}/v1/embeddings",
-                headers=forward_headers,
-                data=await request.body(),
-                timeout=30,
-            ) as resp:
-                data = await resp.json()
+    async def send(inputs, in_use=None):
+        """调用一次上游并记录调用，inputs 为 None 时原样转发请求体，返回 (status, data)"""
+        body = req_body
+        if inputs is not None:
+            body = json.dumps({**req_json, "input": inputs}, ensure_ascii=False).encode()
+
+        resp, selected, tried = await _dispatch(
+            "/v1/embeddings",
+            forward_headers,
+            body,
+            30,
+            use_zero_balance,
+            count_usage=False,
+            model=model,
+            in_use=in_use,
+        )
+
+        try:
+            async with resp:
+                data = await _read_json(resp, selected)
                 # 记录嵌入调用
-                req_json = await request.json()
-                model = req_json.get("model", "unknown")
-                resp_json = await resp.json()
-                usage = resp_json.get("usage", {})
+                usage = data.get("usage", {})
                 prompt_tokens = usage.get("prompt_tokens", 0)
                 call_time_stamp = time.time()
 
-                log_completion(
+                await _record_call(
                     selected,
                     model,
                     call_time_stamp,
@@ -207,17 +256,102 @@ async def embeddings(request: Request, background_tasks: BackgroundTasks):
                     0,
                     prompt_tokens,
                     "embeddings",
+                    tried,
+                )
+                return resp.status, data
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+
+    async def forward():
+        items = split_inputs(req_json.get("input"))
+        if items is None:
+            status, data = await send(None)
+            return JSONResponse(content=data, status_code=status)
+
+        # 按单条输入查缓存，只把未命中的输入发给上游
+        hashes = None
+        cached = {}
+        if embedding_cache.enabled:
+            hashes = [
+                embedding_cache.make_key(
+                    model,
+                    item,
+                    req_json.get("dimensions"),
+                    req_json.get("encoding_format"),
+                )
+                for item in items
+            ]
+            cached = await embedding_cache.get_many(hashes)
+            if len(cached) == len(set(hashes)):
+                return JSONResponse(
+                    content=_embedding_response(model, hashes, cached, {}, {}),
+                    status_code=200,
+                )
+        missing = [
+            i for i in range(len(items)) if hashes is None or hashes[i] not in cached
+        ]
+        inputs = [items[i] for i in missing] if cached else None
+
+        chunk_size = config.FANOUT_EMBEDDING_CHUNK_SIZE
+        if chunk_size > 0 and len(missing) > chunk_size:
+            # 输入很多时分块并发发送到不同的key上，再按原始顺序拼接；
+            # 先于合并判断，否则大请求会被合并进一批、只落到一个key上
+            chunks = chunked([items[i] for i in missing], chunk_size)
+            results = await fan_out(chunks, send)
+            status, data = merge_embeddings(results, [len(c) for c in chunks])
+        elif embedding_batcher.enabled and len(missing) < config.EMBEDDING_BATCH_MAX_ITEMS:
+            # 小请求与其他参数相同的请求合并成一次上游调用
+            status, data = await embedding_batcher.submit(
+                batch_group(req_json, use_zero_balance),
+                [items[i] for i in missing],
+                send,
+            )
+        else:
+            status, data = await send(inputs)
+
+        if hashes is not None and status == 200:
+            # 上游结果中的 index 对应发送的未命中输入，换算回原始位置后写入缓存
+            fetched = {
+                hashes[missing[entry["index"]]]: entry["embedding"]
+                for entry in data.get("data", [])
+            }
+            embedding_cache.put_many(fetched)
+            if cached:
+                data = _embedding_response(
+                    data.get("model", model),
+                    hashes,
+                    cached,
+                    fetched,
+                    data.get("usage", {}),
                 )
 
-                # 后台检查key余额
-                background_tasks.add_task(check_and_remove_key, selected)
-                return JSONResponse(content=data, status_code=resp.status)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+        return JSONResponse(content=data, status_code=status)
+
+    # 相同的并发请求只调用一次上游
+    return await single_flight.run("embeddings", [use_zero_balance, req_json], forward)
+
+
+def _embedding_response(
+    model: str, hashes: list, cached: dict, fetched: dict, usage: dict
+) -> dict:
+    """按原始输入顺序合并缓存命中与上游返回的 embedding"""
+    data = []
+    for index, h in enumerate(hashes):
+        embedding = cached[h] if h in cached else fetched[h]
+        data.append({"object": "embedding", "embedding": embedding, "index": index})
+    return {
+        "object": "list",
+        "data": data,
+        "model": model,
+        "usage": {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "total_tokens": usage.get("total_tokens", 0),
+        },
+    }
 
 
 @router.post("/v1/completions")
-async def completions(request: Request, background_tasks: BackgroundTasks):
+async def completions(request: Request):
     # 检查是否应该使用余额为0的key
     use_zero_balance = False
     if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
@@ -231,27 +365,7 @@ async def completions(request: Request, background_tasks: BackgroundTasks):
         if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
             raise HTTPException(status_code=403, detail="无效的API_KEY")
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
-    )
-    conn.commit()
-
-    # 使用选定的key转发请求到BASE_URL
     forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
 
     try:
         req_body = await request.body()
@@ -263,156 +377,125 @@ async def completions(request: Request, background_tasks: BackgroundTasks):
     call_time_stamp = time.time()
     is_stream = req_json.get("stream", False)
 
+    # 请求上游在流的末尾返回用量，保证计费准确
+    if is_stream and config.STREAM_INCLUDE_USAGE and ensure_stream_usage(req_json):
+        req_body = json.dumps(req_json).encode("utf-8")
+
+    # 使用选定的key转发请求，失败时自动换key重试
+    resp, selected, tried = await _dispatch(
+        "/v1/completions",
+        forward_headers,
+        req_body,
+        300,
+        use_zero_balance,
+        model=model,
+        max_tokens=req_json.get("max_tokens"),
+    )
+
     if is_stream:
 
         async def generate_stream():
-            completion_tokens = 0
-            prompt_tokens = 0
-            total_tokens = 0
+            usage_parser = SSEUsageParser()
 
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{BASE_URL}/v1/completions",
-                        headers=forward_headers,
-                        data=req_body,
-                        timeout=300,
-                    ) as resp:
-                        async for chunk in resp.content.iter_any():
-                            try:
-                                chunk_str = chunk.decode("utf-8")
-                                if chunk_str == "[DONE]":
-                                    continue
-                                if chunk_str.startswith("data: "):
-                                    data = json.loads(chunk_str[6:])
-                                    usage = data.get("usage", {})
-                                    prompt_tokens = usage.get("prompt_tokens", 0)
-                                    completion_tokens = usage.get(
-                                        "completion_tokens", 0
-                                    )
-                                    total_tokens = usage.get("total_tokens", 0)
-                            except Exception:
-                                pass
-                            yield chunk
+                async with resp:
+                    async for chunk in resp.content.iter_any():
+                        usage_parser.feed(chunk)
+                        yield chunk
+                usage_parser.close()
 
                 # 流结束后记录完整token数量
-                log_completion(
+                await _record_call(
                     selected,
                     model,
                     call_time_stamp,
-                    prompt_tokens,
-                    completion_tokens,
-                    total_tokens,
+                    usage_parser.prompt_tokens,
+                    usage_parser.completion_tokens,
+                    usage_parser.total_tokens,
                     "completions",
+                    tried,
                 )
-                await check_and_remove_key(selected)
 
             except Exception as e:
-                error_json = json.dumps({"error": f"请求失败: {str(e)}"}).encode(
-                    "utf-8"
-                )
+                # 流中途失败同样计入该key的熔断器
+                circuit_breakers.record_failure(selected)
+                error_json = json.dumps({"error": f"请求失败: {str(e)}"})
                 yield f"data: {error_json}\n\n".encode("utf-8")
                 yield b"data: [DONE]\n\n"
 
-        try:
-            return StreamingResponse(
-                generate_stream(),
-                headers={"Content-Type": "application/octet-stream"},
-            )
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+        return StreamingResponse(
+            generate_stream(),
+            status_code=resp.status,
+            media_type=_stream_media_type(resp),
+            headers={"Cache-Control": "no-cache"},
+        )
     else:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{BASE_URL}/v1/completions",
-                    headers=forward_headers,
-                    data=req_body,
-                    timeout=300,
-                ) as resp:
-                    resp_json = await resp.json()
-                    usage = resp_json.get("usage", {})
-                    prompt_tokens = usage.get("prompt_tokens", 0)
-                    completion_tokens = usage.get("completion_tokens", 0)
-                    total_tokens = usage.get("total_tokens", 0)
-
-                    # 记录完成调用
-                    log_completion(
-                        selected,
-                        model,
-                        call_time_stamp,
-                        prompt_tokens,
-                        completion_tokens,
-                        total_tokens,
-                        "completions",
-                    )
-
-                    # 后台检查key余额
-                    background_tasks.add_task(check_and_remove_key, selected)
-                    return JSONResponse(content=resp_json, status_code=resp.status)
+            async with resp:
+                resp_json = await _read_json(resp, selected)
+                usage = resp_json.get("usage", {})
+                prompt_tokens = usage.get("prompt_tokens", 0)
+                completion_tokens = usage.get("completion_tokens", 0)
+                total_tokens = usage.get("total_tokens", 0)
+
+                # 记录完成调用
+                await _record_call(
+                    selected,
+                    model,
+                    call_time_stamp,
+                    prompt_tokens,
+                    completion_tokens,
+                    total_tokens,
+                    "completions",
+                    tried,
+                )
+
+                return JSONResponse(content=resp_json, status_code=resp.status)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
 
 
 @router.post("/v1/images/generations")
-async def images_generations(request: Request, background_tasks: BackgroundTasks):
+async def images_generations(request: Request):
     if config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
         request_api_key = request.headers.get("Authorization")
         if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
             raise HTTPException(status_code=403, detail="无效的API_KEY")
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    forward_headers = dict(request.headers)
 
-    selected = select_api_key(keys_with_balance)
-    if not selected:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    req_body = await request.body()
+    req_json = await request.json()
+    model = req_json.get("model", "unknown")
+    call_time_stamp = time.time()
 
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
+    # 图像生成可能需要更长时间
+    resp, selected, tried = await _dispatch(
+        "/v1/images/generations", forward_headers, req_body, 120, model=model
     )
-    conn.commit()
-
-    forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
 
     try:
-        req_body = await request.body()
-        req_json = await request.json()
-        model = req_json.get("model", "unknown")
-        call_time_stamp = time.time()
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{BASE_URL}/v1/images/generations",
-                headers=forward_headers,
-                data=req_body,
-                timeout=120,  # 图像生成可能需要更长时间
-            ) as resp:
-                data = await resp.json()
+        async with resp:
+            data = await _read_json(resp, selected)
 
-                # 图像生成接口可能没有token信息，设置为0
-                prompt_tokens = 0
-                completion_tokens = 0
-                total_tokens = 0
+            # 图像生成接口可能没有token信息，设置为0
+            prompt_tokens = 0
+            completion_tokens = 0
+            total_tokens = 0
 
-                # 记录API调用
-                log_completion(
-                    selected,
-                    model,
-                    call_time_stamp,
-                    prompt_tokens,
-                    completion_tokens,
-                    total_tokens,
-                    "images_generations",
-                )
+            # 记录API调用
+            await _record_call(
+                selected,
+                model,
+                call_time_stamp,
+                prompt_tokens,
+                completion_tokens,
+                total_tokens,
+                "images_generations",
+                tried,
+            )
 
-                # 后台检查key余额
-                background_tasks.add_task(check_and_remove_key, selected)
-                return JSONResponse(content=data, status_code=resp.status)
+            return JSONResponse(content=data, status_code=resp.status)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
 
@@ -433,7 +516,7 @@ async def options_images_generations():
 
 
 @router.post("/v1/rerank")
-async def rerank(request: Request, background_tasks: BackgroundTasks):
+async def rerank(request: Request):
     # 检查是否应该使用余额为0的key
     use_zero_balance = False
     if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
@@ -447,27 +530,7 @@ async def rerank(request: Request, background_tasks: BackgroundTasks):
         if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
             raise HTTPException(status_code=403, detail="无效的API_KEY")
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
-    )
-    conn.commit()
-
-    # 使用选定的key转发请求到BASE_URL
     forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
 
     try:
         req_body = await request.body()
@@ -476,23 +539,31 @@ async def rerank(request: Request, background_tasks: BackgroundTasks):
 
     req_json = await request.json()
     model = req_json.get("model", "unknown")
-    call_time_stamp = time.time()
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{BASE_URL}/v1/rerank",
-                headers=forward_headers,
-                data=req_body,
-                timeout=300,
-            ) as resp:
-                resp_json = await resp.json()
+    async def send(body, in_use=None):
+        """调用一次上游并记录调用，返回 (status, data)"""
+        call_time_stamp = time.time()
+
+        # 使用选定的key转发请求，失败时自动换key重试
+        resp, selected, tried = await _dispatch(
+            "/v1/rerank",
+            forward_headers,
+            body,
+            300,
+            use_zero_balance,
+            model=model,
+            in_use=in_use,
+        )
+
+        try:
+            async with resp:
+                resp_json = await _read_json(resp, selected)
                 meta_data = resp_json.get("meta", {})
                 tokens_usage = meta_data.get("tokens", {})
                 input_tokens = tokens_usage.get("input_tokens", 0)
                 output_tokens = tokens_usage.get("output_tokens", 0)
                 # 记录API调用
-                log_completion(
+                await _record_call(
                     selected,
                     model,
                     call_time_stamp,
@@ -500,34 +571,79 @@ async def rerank(request: Request, background_tasks: BackgroundTasks):
                     output_tokens,  # completion_tokens
                     input_tokens + output_tokens,  # total_tokens
                     "rerank",
+                    tried,
                 )
-                # 后台检查key余额
-                background_tasks.add_task(check_and_remove_key, selected)
-                return JSONResponse(content=resp_json, status_code=resp.status)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+                return resp.status, resp_json
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+
+    async def forward():
+        documents = req_json.get("documents")
+        chunk_size = config.FANOUT_RERANK_CHUNK_SIZE
+        if (
+            chunk_size > 0
+            and isinstance(documents, list)
+            and len(documents) > chunk_size
+        ):
+            # 文档很多时分块并发发送到不同的key上，再合并得分重新排序
+            chunks = chunked(documents, chunk_size)
+
+            async def send_chunk(chunk, in_use):
+                body = json.dumps({**req_json, "documents": chunk}, ensure_ascii=False)
+                return await send(body.encode(), in_use)
+
+            results = await fan_out(chunks, send_chunk)
+            status, data = merge_rerank(
+                results, [len(c) for c in chunks], req_json.get("top_n")
+            )
+        else:
+            status, data = await send(req_body)
+        return JSONResponse(content=data, status_code=status)
+
+    # 相同的并发请求只调用一次上游
+    return await single_flight.run("rerank", [use_zero_balance, req_json], forward)
 
 
 @router.get("/v1/models")
 async def list_models(request: Request):
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance)
-    if not selected:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    # 余额为0的key能看到的模型列表不同，分别缓存
+    use_zero_balance = False
+    if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
+        request_api_key = request.headers.get("Authorization", "")
+        if request_api_key == f"Bearer {config.FREE_MODEL_API_KEY}":
+            use_zero_balance = True
 
     forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{BASE_URL}/v1/models", headers=forward_headers, timeout=30
-            ) as resp:
-                data = await resp.json()
+    async def forward():
+        resp, selected, _ = await _dispatch(
+            "/v1/models",
+            forward_headers,
+            None,
+            30,
+            use_zero_balance,
+            count_usage=False,
+            method="GET",
+        )
+
+        try:
+            async with resp:
+                data = await _read_json(resp, selected)
                 return JSONResponse(content=data, status_code=resp.status)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
+
+    if not models_cache.enabled:
+        # 相同的并发请求只调用一次上游
+        return await single_flight.run("models", [use_zero_balance], forward)
+
+    key_class = "zero_balance" if use_zero_balance else "paid"
+    entry, error = await models_cache.get(key_class, forward)
+    if entry is None:
+        return error
+
+    # 客户端已有相同版本时只返回 304
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
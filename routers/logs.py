@@ -1,92 +1,274 @@
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
-from db import conn, cursor
+from fastapi.responses import JSONResponse, StreamingResponse
+from db import (
+    DIMENSION_TABLES,
+    LOG_COLUMNS,
+    ROLLUP_BUCKET_MS,
+    database,
+    format_log_rows,
+    log_dimensions,
+)
+from retention import log_retention
+from utils import clamp_page_size, decode_cursor, encode_cursor
 from datetime import datetime
+import csv
+import io
+import json
 import time
+import zlib
 
 router = APIRouter()
 
 
-@router.get("/logs")
-async def get_logs(
-    page: int = 1, date_filter: str = "all", model: str = "all", endpoint: str = "all"
-):
-    page_size = 10
-    offset = (page - 1) * page_size
+# 导出日志时每批读取的条数
+EXPORT_BATCH_SIZE = 1000
+
+# CSV 导出的列，tried_keys 中的多个key以 | 分隔
+EXPORT_CSV_COLUMNS = [
+    "used_key",
+    "model",
+    "endpoint",
+    "call_time",
+    "input_tokens",
+    "output_tokens",
+    "total_tokens",
+    "tried_keys",
+]
+
+# 近似总数的缓存时间（秒）
+TOTAL_CACHE_TTL = 30
+
+# (date_filter, model, endpoint) -> (过期时间, 总数)
+_total_cache = {}
 
-    # 构建查询条件
-    query_conditions = []
-    query_params = []
+
+def _filter_id(table: str, name: str) -> int:
+    """把过滤条件中的名称换算为id，从未出现过的名称返回不会匹配任何记录的 -1"""
+    id_ = log_dimensions.id_of(table, name)
+    return -1 if id_ is None else id_
+
+
+def _build_filters(date_filter: str, model: str, endpoint: str):
+    """根据日期、模型与接口过滤条件构建查询条件
+
+    Returns:
+        (条件列表, 参数列表, 日期过滤的起始时间戳（秒），不按日期过滤时为None)
+    """
+    conditions = []
+    params = []
 
     # 日期过滤
+    start_timestamp = None
     if date_filter == "today":
         # 获取今天的开始时间戳
         today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         start_timestamp = time.mktime(today.timetuple())
-        query_conditions.append("call_time >= ?")
-        query_params.append(start_timestamp)
+        conditions.append("call_time >= ?")
+        params.append(int(start_timestamp * 1000))
 
     # 模型过滤
     if model != "all":
-        query_conditions.append("model = ?")
-        query_params.append(model)
+        conditions.append("model_id = ?")
+        params.append(_filter_id("log_models", model))
 
     # 接口过滤
     if endpoint != "all":
-        query_conditions.append("endpoint = ?")
-        query_params.append(endpoint)
+        conditions.append("endpoint_id = ?")
+        params.append(_filter_id("log_endpoints", endpoint))
+
+    return conditions, params, start_timestamp
+
+
+async def _approximate_total(
+    date_filter: str, model: str, endpoint: str, start_timestamp: float
+):
+    """从按小时汇总的统计表估算符合条件的日志条数，结果短暂缓存"""
+    cache_key = (date_filter, model, endpoint)
+    cached = _total_cache.get(cache_key)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return cached[1]
+
+    # 汇总统计永久保留，只统计仍保留原始日志的时间段
+    oldest = (await database.fetchone("SELECT MIN(call_time) FROM logs"))[0]
+    if oldest is None:
+        _total_cache[cache_key] = (now + TOTAL_CACHE_TTL, 0)
+        return 0
+    start_ms = oldest // ROLLUP_BUCKET_MS * ROLLUP_BUCKET_MS
+    if start_timestamp is not None:
+        start_ms = max(start_ms, int(start_timestamp * 1000))
+
+    conditions = ["hour_start >= ?"]
+    params = [start_ms]
+    if model != "all":
+        conditions.append("model_id = ?")
+        params.append(_filter_id("log_models", model))
+    if endpoint != "all":
+        conditions.append("endpoint_id = ?")
+        params.append(_filter_id("log_endpoints", endpoint))
+    where_clause = " AND ".join(conditions)
+    row = await database.fetchone(
+        f"SELECT COALESCE(SUM(calls), 0) FROM log_rollups WHERE {where_clause}",
+        params,
+    )
+    _total_cache[cache_key] = (now + TOTAL_CACHE_TTL, row[0])
+    return row[0]
+
+
+@router.get("/logs")
+async def get_logs(
+    cursor: str = None,
+    page_size: int = 10,
+    date_filter: str = "all",
+    model: str = "all",
+    endpoint: str = "all",
+    with_total: bool = True,
+):
+    """按调用时间倒序分页获取日志
+
+    使用 (call_time, id) 作为游标翻页，翻到很深的页也不需要扫描前面的记录。
+    total 为按汇总统计估算的近似总数，只在 with_total 为真时返回。
+    """
+    page_size = clamp_page_size(page_size)
+
+    # 构建查询条件
+    query_conditions, query_params, start_timestamp = _build_filters(
+        date_filter, model, endpoint
+    )
+
+    # 游标位置：只取排在上一页最后一条之后的记录
+    if cursor:
+        position = decode_cursor(cursor, 2)
+        if position is None:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+        query_conditions.append("(call_time, id) < (?, ?)")
+        query_params.extend(position)
 
     # 组装WHERE子句
     where_clause = " AND ".join(query_conditions) if query_conditions else "1=1"
 
-    # 获取总记录数
-    count_query = f"SELECT COUNT(*) FROM logs WHERE {where_clause}"
-    cursor.execute(count_query, query_params)
-    total = cursor.fetchone()[0]
-
-    # 获取过滤后的日志
+    # 多取一条用于判断是否还有下一页
     logs_query = f"""
-        SELECT used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint 
-        FROM logs 
-        WHERE {where_clause} 
-        ORDER BY call_time DESC 
-        LIMIT ? OFFSET ?
+        SELECT {LOG_COLUMNS}
+        FROM logs
+        WHERE {where_clause}
+        ORDER BY call_time DESC, id DESC
+        LIMIT ?
     """
-    cursor.execute(logs_query, query_params + [page_size, offset])
-    logs = cursor.fetchall()
+    logs = await database.fetchall(logs_query, query_params + [page_size + 1])
+    next_cursor = None
+    if len(logs) > page_size:
+        logs = logs[:page_size]
+        next_cursor = encode_cursor([logs[-1][3], logs[-1][8]])
+
+    total = None
+    if with_total:
+        total = await _approximate_total(date_filter, model, endpoint, start_timestamp)
 
     # 将日志格式化为字典列表
-    log_list = [
+    log_list = format_log_rows(logs)
+
+    return JSONResponse(
         {
-            "used_key": row[0],
-            "model": row[1],
-            "call_time": row[2],
-            "input_tokens": row[3],
-            "output_tokens": row[4],
-            "total_tokens": row[5],
-            "endpoint": row[6] or "未知",  # 为了向后兼容，对空值使用默认值
+            "logs": log_list,
+            "total": total,
+            "next_cursor": next_cursor,
+            "page_size": page_size,
         }
-        for row in logs
-    ]
+    )
+
+
+async def _iter_export_rows(conditions: list, params: list):
+    """按 (call_time, id) 顺序分批读取日志，每批都是一次独立的短查询"""
+    position = None
+    while True:
+        batch_conditions = list(conditions)
+        batch_params = list(params)
+        if position is not None:
+            batch_conditions.append("(call_time, id) > (?, ?)")
+            batch_params.extend(position)
+        where_clause = " AND ".join(batch_conditions) if batch_conditions else "1=1"
+        rows = await database.fetchall(
+            f"SELECT {LOG_COLUMNS} FROM logs WHERE {where_clause} ORDER BY call_time, id LIMIT ?",
+            batch_params + [EXPORT_BATCH_SIZE],
+        )
+        if not rows:
+            return
+        yield format_log_rows(rows)
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+        position = (rows[-1][3], rows[-1][8])
 
-    # 获取所有可用的模型列表，用于前端过滤下拉框
-    cursor.execute("SELECT DISTINCT model FROM logs ORDER BY model")
-    available_models = [row[0] for row in cursor.fetchall()]
 
-    # 获取所有可用的接口类型，用于前端过滤下拉框
-    cursor.execute(
-        "SELECT DISTINCT endpoint FROM logs WHERE endpoint IS NOT NULL ORDER BY endpoint"
+def _encode_ndjson(records: list) -> str:
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+def _encode_csv(records: list) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow(
+            [record[column] for column in EXPORT_CSV_COLUMNS[:-1]]
+            + ["|".join(k or "" for k in record["tried_keys"])]
+        )
+    return buffer.getvalue()
+
+
+@router.get("/logs/export")
+async def export_logs(
+    format: str = "ndjson",
+    gzip: bool = False,
+    date_filter: str = "all",
+    model: str = "all",
+    endpoint: str = "all",
+):
+    """按调用时间顺序流式导出日志，支持 NDJSON / CSV 以及 gzip 压缩
+
+    日志分批读取并逐批写出，内存占用与导出的总条数无关。
+    """
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="不支持的导出格式")
+    conditions, params, _ = _build_filters(date_filter, model, endpoint)
+    encode = _encode_csv if format == "csv" else _encode_ndjson
+
+    async def generate():
+        compressor = zlib.compressobj(wbits=31) if gzip else None
+        if format == "csv":
+            header = ",".join(EXPORT_CSV_COLUMNS) + "\r\n"
+            yield compressor.compress(header.encode()) if compressor else header.encode()
+        async for records in _iter_export_rows(conditions, params):
+            data = encode(records).encode()
+            if compressor:
+                data = compressor.compress(data)
+                if not data:
+                    continue
+            yield data
+        if compressor:
+            yield compressor.flush()
+
+    filename = f"logs.{format}" + (".gz" if gzip else "")
+    if gzip:
+        media_type = "application/gzip"
+    elif format == "csv":
+        media_type = "text/csv; charset=utf-8"
+    else:
+        media_type = "application/x-ndjson"
+    return StreamingResponse(
+        generate(),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
-    available_endpoints = [row[0] for row in cursor.fetchall()]
 
+
+@router.get("/logs/filters")
+async def get_log_filters():
+    """获取日志中出现过的模型与接口，用于前端过滤下拉框"""
+    dimensions = log_dimensions.snapshot()
     return JSONResponse(
         {
-            "logs": log_list,
-            "total": total,
-            "page": page,
-            "page_size": page_size,
-            "available_models": available_models,
-            "available_endpoints": available_endpoints,
+            "available_models": dimensions["models"],
+            "available_endpoints": dimensions["endpoints"],
         }
     )
 
@@ -94,10 +276,18 @@ async def get_logs(
 @router.post("/clear_logs")
 async def clear_logs():
     try:
-        cursor.execute("DELETE FROM logs")
-        conn.commit()
-        cursor.execute("VACUUM")
-        conn.commit()
+        def clear(conn):
+            conn.execute("DELETE FROM logs")
+            conn.execute("DELETE FROM log_rollups")
+            for table in DIMENSION_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            # 在写线程中清空，保证之后写入的日志重新分配id
+            log_dimensions.clear()
+
+        await database.write(clear)
+        # 空间在后台逐步回收，不阻塞写线程
+        log_retention.schedule_vacuum()
+        _total_cache.clear()
         return JSONResponse({"message": "日志已清空"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"清空日志失败: {str(e)}")
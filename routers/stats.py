@@ -1,12 +1,50 @@
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
-from db import cursor
+from db import database, log_dimensions, write_buffer
+from embedding_batcher import embedding_batcher
+from embedding_cache import embedding_cache
+from models_cache import models_cache
+from singleflight import single_flight
 import time
 from datetime import datetime, timedelta
 
 router = APIRouter()
 
 
+async def _rollup_stats(start_timestamp: float, end_timestamp: float, fmt: str):
+    """从按小时汇总的统计表中查询时间段内的调用数据
+
+    Returns:
+        (按时间单位汇总的 [单位, 调用次数, 输入token, 输出token] 列表,
+         按 token 消耗降序排列的 [模型, token] 列表)
+    """
+    start_ms = int(start_timestamp * 1000)
+    end_ms = int(end_timestamp * 1000)
+    buckets = await database.fetchall(
+        f"""
+        SELECT strftime('{fmt}', datetime(hour_start / 1000, 'unixepoch', 'localtime')) as unit,
+               SUM(calls), SUM(input_tokens), SUM(output_tokens)
+        FROM log_rollups
+        WHERE hour_start >= ? AND hour_start < ?
+        GROUP BY unit
+        """,
+        (start_ms, end_ms),
+    )
+    rows = await database.fetchall(
+        """
+        SELECT model_id, SUM(total_tokens) as tokens
+        FROM log_rollups
+        WHERE hour_start >= ? AND hour_start < ?
+        GROUP BY model_id
+        ORDER BY tokens DESC
+        """,
+        (start_ms, end_ms),
+    )
+    names = log_dimensions.names_of("log_models")
+    models = [(names.get(model_id), tokens) for model_id, tokens in rows]
+    return buckets, models
+
+
 @router.get("/api/stats/daily")
 async def get_daily_stats():
     """获取当天按小时统计的API调用数据"""
@@ -21,58 +59,16 @@ async def get_daily_stats():
     input_tokens_by_hour = {hour: 0 for hour in hours}
     output_tokens_by_hour = {hour: 0 for hour in hours}
 
-    # 查询调用次数
-    cursor.execute(
-        """
-        SELECT strftime('%H', datetime(call_time, 'unixepoch', 'localtime')) as hour,
-               COUNT(*) as call_count
-        FROM logs
-        WHERE call_time >= ? AND call_time < ?
-        GROUP BY hour
-        """,
-        (start_timestamp, end_timestamp),
-    )
+    buckets, model_rows = await _rollup_stats(start_timestamp, end_timestamp, "%H")
 
-    for row in cursor.fetchall():
+    for row in buckets:
         hour = int(row[0])
         calls_by_hour[hour] = row[1]
+        input_tokens_by_hour[hour] = row[2]
+        output_tokens_by_hour[hour] = row[3]
 
-    # 查询token消耗
-    cursor.execute(
-        """
-        SELECT strftime('%H', datetime(call_time, 'unixepoch', 'localtime')) as hour,
-               SUM(input_tokens) as total_input,
-               SUM(output_tokens) as total_output
-        FROM logs
-        WHERE call_time >= ? AND call_time < ?
-        GROUP BY hour
-        """,
-        (start_timestamp, end_timestamp),
-    )
-
-    for row in cursor.fetchall():
-        hour = int(row[0])
-        input_tokens_by_hour[hour] = row[1]
-        output_tokens_by_hour[hour] = row[2]
-
-    # 查询模型使用情况
-    cursor.execute(
-        """
-        SELECT model, SUM(total_tokens) as tokens
-        FROM logs
-        WHERE call_time >= ? AND call_time < ?
-        GROUP BY model
-        ORDER BY tokens DESC
-        """,
-        (start_timestamp, end_timestamp),
-    )
-
-    models = []
-    model_tokens = []
-
-    for row in cursor.fetchall():
-        models.append(row[0])
-        model_tokens.append(row[1])
+    models = [row[0] for row in model_rows]
+    model_tokens = [row[1] for row in model_rows]
 
     return JSONResponse(
         {
@@ -110,58 +106,16 @@ async def get_monthly_stats():
     input_tokens_by_day = {day: 0 for day in days}
     output_tokens_by_day = {day: 0 for day in days}
 
-    # 查询调用次数
-    cursor.execute(
-        """
-        SELECT strftime('%d', datetime(call_time, 'unixepoch', 'localtime')) as day,
-               COUNT(*) as call_count
-        FROM logs
-        WHERE call_time >= ? AND call_time < ?
-        GROUP BY day
-        """,
-        (start_timestamp, end_timestamp),
-    )
+    buckets, model_rows = await _rollup_stats(start_timestamp, end_timestamp, "%d")
 
-    for row in cursor.fetchall():
+    for row in buckets:
         day = int(row[0])
         calls_by_day[day] = row[1]
+        input_tokens_by_day[day] = row[2]
+        output_tokens_by_day[day] = row[3]
 
-    # 查询token消耗
-    cursor.execute(
-        """
-        SELECT strftime('%d', datetime(call_time, 'unixepoch', 'localtime')) as day,
-               SUM(input_tokens) as total_input,
-               SUM(output_tokens) as total_output
-        FROM logs
-        WHERE call_time >= ? AND call_time < ?
-        GROUP BY day
-        """,
-        (start_timestamp, end_timestamp),
-    )
-
-    for row in cursor.fetchall():
-        day = int(row[0])
-        input_tokens_by_day[day] = row[1]
-        output_tokens_by_day[day] = row[2]
-
-    # 查询模型使用情况
-    cursor.execute(
-        """
-        SELECT model, SUM(total_tokens) as tokens
-        FROM logs
-        WHERE call_time >= ? AND call_time < ?
-        GROUP BY model
-        ORDER BY tokens DESC
-        """,
-        (start_timestamp, end_timestamp),
-    )
-
-    models = []
-    model_tokens = []
-
-    for row in cursor.fetchall():
-        models.append(row[0])
-        model_tokens.append(row[1])
+    models = [row[0] for row in model_rows]
+    model_tokens = [row[1] for row in model_rows]
 
     return JSONResponse(
         {
@@ -173,3 +127,33 @@ async def get_monthly_stats():
             "model_tokens": model_tokens,
         }
     )
+
+
+@router.get("/api/stats/write_buffer")
+async def get_write_buffer_stats():
+    """获取日志写缓冲的队列深度与写入耗时"""
+    return JSONResponse(write_buffer.snapshot())
+
+
+@router.get("/api/stats/embedding_cache")
+async def get_embedding_cache_stats():
+    """返回 embeddings 缓存的命中统计"""
+    return JSONResponse(embedding_cache.snapshot())
+
+
+@router.get("/api/stats/embedding_batcher")
+async def get_embedding_batcher_stats():
+    """返回 embeddings 请求合并的批次统计"""
+    return JSONResponse(embedding_batcher.snapshot())
+
+
+@router.get("/api/stats/single_flight")
+async def get_single_flight_stats():
+    """返回请求合并的次数统计"""
+    return JSONResponse(single_flight.snapshot())
+
+
+@router.get("/api/stats/models_cache")
+async def get_models_cache_stats():
+    """返回模型列表缓存的命中统计与各份缓存的年龄（秒）"""
+    return JSONResponse(models_cache.snapshot())
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+from fastapi.responses import Response
+import config
+
+
+class _Flight:
+    __slots__ = ("task", "finished_at")
+
+    def __init__(self, task):
+        self.task = task
+        self.finished_at = None
+
+
+class SingleFlight:
+    """合并相同的并发请求
+
+    请求体规范化后相同的请求共享同一次上游调用，所有等待者拿到相同的响应字节。
+    上游调用结束后结果还会保留 single_flight_window_ms 毫秒，
+    让几乎同时到达、只是稍晚一步的请求也能复用。
+    上游调用在独立的任务中执行，发起者断开连接不会影响其他等待者。
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def enabled(self, endpoint: str) -> bool:
+        return endpoint in config.SINGLE_FLIGHT_ENDPOINTS
+
+    async def run(self, endpoint: str, payload, call) -> Response:
+        """执行 call() 并返回其响应，相同 (endpoint, payload) 的并发请求只执行一次
+
+        Args:
+            endpoint: 接口名称，未在 single_flight_endpoints 中配置的接口直接执行
+            payload: 决定响应内容的全部参数，需要可以序列化为 JSON
+            call: 返回 Response 的协程函数
+        """
+        if not self.enabled(endpoint):
+            return await call()
+
+        key = endpoint + ":" + json.dumps(
+            payload, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+        )
+        flight = self._flights.get(key)
+        window = config.SINGLE_FLIGHT_WINDOW_MS / 1000
+        if flight is not None and (
+            flight.finished_at is None or time.monotonic() - flight.finished_at < window
+        ):
+            self.shared += 1
+        else:
+            flight = _Flight(asyncio.create_task(call()))
+            self._flights[key] = flight
+            self.leaders += 1
+            flight.task.add_done_callback(
+                lambda _: self._finish(key, flight, window)
+            )
+
+        resp = await asyncio.shield(flight.task)
+        # 每个等待者使用独立的响应对象，内容字节相同
+        return Response(
+            content=resp.body,
+            status_code=resp.status_code,
+            media_type=resp.media_type,
+        )
+
+    def _finish(self, key: str, flight: _Flight, window: float):
+        flight.finished_at = time.monotonic()
+        # 出错的结果不保留，之后的请求重新调用上游
+        failed = flight.task.cancelled() or flight.task.exception() is not None
+        if window > 0 and not failed:
+            asyncio.get_running_loop().call_later(window, self._expire, key, flight)
+        else:
+            self._expire(key, flight)
+
+    def _expire(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight": sum(1 for f in self._flights.values() if f.finished_at is None),
+            "leaders": self.leaders,
+            "shared": self.shared,
+        }
+
+
+# 全局请求合并器
+single_flight = SingleFlight()
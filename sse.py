@@ -0,0 +1,87 @@
+import json
+
+
+class SSEUsageParser:
+    """增量解析上游SSE流中的token用量
+
+    上游的字节块原样透传给客户端，这里只在内部按空行切分事件，
+    正确处理一个块中包含多个事件或事件跨块的情况；
+    只有包含 "usage" 字样的事件才会做完整的JSON解析。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 下次查找事件分隔符的起始位置，避免重复扫描长事件
+        self._scan_from = 0
+        # 上一块以 \r 结尾，尚未确定它是否属于 \r\n
+        self._pending_cr = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+
+    def feed(self, chunk: bytes):
+        """喂入一个上游字节块"""
+        if self._pending_cr:
+            chunk = b"\r" + chunk
+            self._pending_cr = False
+        if chunk.endswith(b"\r"):
+            # \r\n 可能被拆在两个块之间，留到下一块再判断，避免误判为空行
+            chunk = chunk[:-1]
+            self._pending_cr = True
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        self._buffer += chunk
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n\n", max(start, self._scan_from))
+            if end < 0:
+                break
+            self._handle_event(bytes(self._buffer[start:end]))
+            start = end + 2
+            self._scan_from = start
+        if start:
+            del self._buffer[:start]
+        self._scan_from = max(0, len(self._buffer) - 1)
+
+    def close(self):
+        """流结束时处理缓冲区中残留的最后一个事件"""
+        self._pending_cr = False
+        if self._buffer:
+            self._handle_event(bytes(self._buffer))
+            self._buffer.clear()
+        self._scan_from = 0
+
+    def _handle_event(self, event: bytes):
+        if b'"usage"' not in event:
+            return
+        data_lines = []
+        for line in event.split(b"\n"):
+            if line.startswith(b"data:"):
+                data = line[5:]
+                if data.startswith(b" "):
+                    data = data[1:]
+                data_lines.append(data)
+        payload = b"\n".join(data_lines)
+        if not payload or payload == b"[DONE]":
+            return
+        try:
+            usage = json.loads(payload).get("usage")
+        except Exception:
+            return
+        if not isinstance(usage, dict) or not usage:
+            return
+        self.prompt_tokens = usage.get("prompt_tokens", 0) or 0
+        self.completion_tokens = usage.get("completion_tokens", 0) or 0
+        self.total_tokens = usage.get("total_tokens", 0) or 0
+
+
+def ensure_stream_usage(req_json: dict) -> bool:
+    """为流式请求注入 stream_options.include_usage，返回是否修改了请求体"""
+    stream_options = req_json.get("stream_options")
+    if not isinstance(stream_options, dict):
+        stream_options = {}
+    if stream_options.get("include_usage"):
+        return False
+    stream_options["include_usage"] = True
+    req_json["stream_options"] = stream_options
+    return True
@@ -55,14 +55,39 @@ async function fetchStats() {
 }
 
 /**
- * 刷新所有密钥
+ * 刷新所有密钥，通过 SSE 显示进度
+ * @returns {Promise} 刷新任务结束时完成
  */
 async function refreshKeys() {
     showMessage("正在刷新，请稍候...", "success");
-    const response = await fetch("/refresh", { method: "POST" });
-    const data = await response.json();
-    showMessage(data.message, "success");
-    fetchStats();
+    await fetch("/refresh", { method: "POST" });
+    return followRefresh();
+}
+
+/**
+ * 通过 SSE 显示当前刷新任务的进度
+ * @returns {Promise} 刷新任务结束时完成
+ */
+function followRefresh() {
+    return new Promise(resolve => {
+        const source = new EventSource("/refresh/progress");
+        source.onmessage = event => {
+            const progress = JSON.parse(event.data);
+            if (progress.finished) {
+                source.close();
+                showMessage(progress.message, "success");
+                fetchStats();
+                resolve(progress);
+            } else {
+                showMessage(`正在刷新 ${progress.checked}/${progress.total}，已移除 ${progress.removed} 个无效的 Key`, "success");
+            }
+        };
+        source.onerror = () => {
+            source.close();
+            fetchStats();
+            resolve(null);
+        };
+    });
 }
 
 /**
@@ -79,108 +104,68 @@ function maskKey(key) {
 }
 
 /**
- * 创建改进的分页UI
- * @param {number} currentPage 当前页码
- * @param {number} totalPages 总页数
- * @param {function} callback 页码点击回调函数
+ * 创建游标分页状态
+ * @param {number} pageSize 每页条数
+ * @returns {object} 分页状态，cursors[i] 为第 i 页的游标（第一页为 null）
  */
-function renderPagination(currentPage, totalPages, callback) {
-    const paginationDiv = document.getElementById("pagination");
-    paginationDiv.innerHTML = "";
-
-    if (totalPages <= 1) return;
-
-    // 确保当前页码合法
-    currentPage = Math.max(1, Math.min(currentPage, totalPages));
-
-    // 添加第一页按钮
-    addPageButton(paginationDiv, 1, currentPage, callback);
-
-    // 显示省略号和中间的页码
-    if (totalPages > 7) {
-        let startPage = Math.max(2, currentPage - 2);
-        let endPage = Math.min(totalPages - 1, currentPage + 2);
-
-        if (currentPage - 2 > 2) {
-            paginationDiv.appendChild(createEllipsis());
-        }
-
-        for (let i = startPage; i <= endPage; i++) {
-            addPageButton(paginationDiv, i, currentPage, callback);
-        }
-
-        if (currentPage + 2 < totalPages - 1) {
-            paginationDiv.appendChild(createEllipsis());
-        }
-    } else {
-        // 如果页数较少，则全部显示
-        for (let i = 2; i < totalPages; i++) {
-            addPageButton(paginationDiv, i, currentPage, callback);
-        }
-    }
-
-    // 添加最后一页按钮(如果总页数大于1)
-    if (totalPages > 1) {
-        addPageButton(paginationDiv, totalPages, currentPage, callback);
-    }
-
-    // 添加页面跳转输入框
-    const jumpDiv = document.createElement('div');
-    jumpDiv.className = 'page-jump';
-    jumpDiv.innerHTML = `
-        <span>跳至</span>
-        <input type="number" min="1" max="${totalPages}" value="${currentPage}" id="pageJumpInput">
-        <span>页</span>
-        <button class="secondary">确定</button>
-    `;
-    paginationDiv.appendChild(jumpDiv);
-
-    // 为跳转按钮添加事件监听
-    jumpDiv.querySelector('button').addEventListener('click', function () {
-        const pageInput = document.getElementById('pageJumpInput');
-        let targetPage = parseInt(pageInput.value);
-        if (isNaN(targetPage)) targetPage = currentPage;
-        targetPage = Math.max(1, Math.min(targetPage, totalPages));
-        if (targetPage !== currentPage) {
-            callback(targetPage);
-        }
-    });
-
-    // 为输入框添加回车事件
-    jumpDiv.querySelector('input').addEventListener('keypress', function (e) {
-        if (e.key === 'Enter') {
-            jumpDiv.querySelector('button').click();
-        }
-    });
+function createPager(pageSize = 10) {
+    return { cursors: [null], index: 0, pageSize: pageSize, total: null };
 }
 
 /**
- * 创建页码按钮
- * @param {HTMLElement} container 容器元素
- * @param {number} page 页码
- * @param {number} currentPage 当前页码
- * @param {function} callback 点击回调函数
+ * 创建游标分页UI（上一页/下一页 + 每页条数）
+ * @param {object} pager 由 createPager 创建的分页状态
+ * @param {string|null} nextCursor 服务端返回的下一页游标，为空表示已是最后一页
+ * @param {function} callback 翻页回调函数，参数为目标页序号（从0开始）
  */
-function addPageButton(container, page, currentPage, callback) {
-    const btn = document.createElement("button");
-    btn.textContent = page;
-    btn.className = currentPage === page ? "current" : "secondary";
-    btn.disabled = currentPage === page;
-    if (currentPage !== page) {
-        btn.onclick = () => callback(page);
-    }
-    container.appendChild(btn);
-}
+function renderCursorPagination(pager, nextCursor, callback) {
+    const paginationDiv = document.getElementById("pagination");
+    paginationDiv.innerHTML = "";
 
-/**
- * 创建省略号元素
- * @returns {HTMLSpanElement} 省略号元素
- */
-function createEllipsis() {
-    const span = document.createElement('span');
-    span.className = 'ellipsis';
-    span.textContent = '...';
-    return span;
+    const prevBtn = document.createElement("button");
+    prevBtn.textContent = "上一页";
+    prevBtn.className = "secondary";
+    prevBtn.disabled = pager.index === 0;
+    prevBtn.onclick = () => callback(pager.index - 1);
+    paginationDiv.appendChild(prevBtn);
+
+    const info = document.createElement("span");
+    info.className = "page-info";
+    info.textContent = `第 ${pager.index + 1} 页`;
+    if (pager.total !== null) {
+        const totalPages = Math.max(1, Math.ceil(pager.total / pager.pageSize));
+        info.textContent += ` / 约 ${totalPages} 页（约 ${pager.total} 条）`;
+    }
+    paginationDiv.appendChild(info);
+
+    const nextBtn = document.createElement("button");
+    nextBtn.textContent = "下一页";
+    nextBtn.className = "secondary";
+    nextBtn.disabled = !nextCursor;
+    nextBtn.onclick = () => {
+        pager.cursors[pager.index + 1] = nextCursor;
+        callback(pager.index + 1);
+    };
+    paginationDiv.appendChild(nextBtn);
+
+    // 每页条数选择，修改后回到第一页
+    const sizeDiv = document.createElement("div");
+    sizeDiv.className = "page-jump";
+    const select = document.createElement("select");
+    [10, 20, 50, 100].forEach(size => {
+        const option = document.createElement("option");
+        option.value = size;
+        option.textContent = `${size} 条/页`;
+        option.selected = size === pager.pageSize;
+        select.appendChild(option);
+    });
+    select.onchange = () => {
+        pager.pageSize = parseInt(select.value);
+        pager.cursors = [null];
+        callback(0);
+    };
+    sizeDiv.appendChild(select);
+    paginationDiv.appendChild(sizeDiv);
 }
 
 /**
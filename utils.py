@@ -1,25 +1,29 @@
 import re
-import random
+import time
+import base64
+import json
 import config
-import aiohttp
 import logging
-from db import conn, cursor
+from http_client import get_session, request_timeout
+from db import database
+from key_pool import key_pool
 
 
 async def validate_key_async(api_key: str):
     """异步验证API密钥的有效性并获取余额"""
     headers = {"Authorization": f"Bearer {api_key}"}
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://api.siliconflow.cn/v1/user/info", headers=headers, timeout=10
-            ) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    return True, data.get("data", {}).get("totalBalance", 0)
-                else:
-                    data = await r.json()
-                    return False, data.get("message", "验证失败")
+        async with get_session().get(
+            "https://api.siliconflow.cn/v1/user/info",
+            headers=headers,
+            timeout=request_timeout(10),
+        ) as r:
+            if r.status == 200:
+                data = await r.json()
+                return True, data.get("data", {}).get("totalBalance", 0)
+            else:
+                data = await r.json()
+                return False, data.get("message", "验证失败")
     except Exception as e:
         return False, f"请求失败: {str(e)}"
 
@@ -38,98 +42,47 @@ def clean_key(key: str) -> str:
     return key.strip()
 
 
-def select_api_key(keys_with_balance, use_zero_balance=False):
-    """根据配置策略选择一个API密钥
-    
-    Args:
-        keys_with_balance: API密钥及余额的列表
-        use_zero_balance: 是否优先使用余额为0的密钥
-    
-    Returns:
-        选择的API密钥
-    """
-    # keys_with_balance: list of (key, balance)
-    if not keys_with_balance:
-        return None
+def encode_cursor(values: list) -> str:
+    """把分页位置编码为不透明的游标字符串"""
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
 
-    # 只选择启用的key
-    cursor.execute(
-        "SELECT key, balance FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-            ",".join("?" for _ in range(len(keys_with_balance)))
-        ),
-        [k[0] for k in keys_with_balance],
-    )
-    enabled_keys = cursor.fetchall()
 
-    if not enabled_keys:
-        return None
-    
-    # 如果指定使用余额为0的key，则筛选出余额为0的key
-    if use_zero_balance:
-        zero_balance_keys = [k for k in enabled_keys if float(k[1]) <= 0]
-        if zero_balance_keys:
-            # 使用余额为0的key时，固定使用随机策略
-            return random.choice(zero_balance_keys)[0]
-        # 如果没有余额为0的key，则返回None，表示无法处理此请求
+def decode_cursor(cursor: str, length: int):
+    """解析游标字符串，格式不正确时返回None"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
         return None
-    
-    # 如果不使用余额为0的key，则筛选出余额大于0的key
-    positive_balance_keys = [k for k in enabled_keys if float(k[1]) > 0]
-    if not positive_balance_keys:
+    if not isinstance(values, list) or len(values) != length:
         return None
-    
-    # 使用正常的选择策略
-    enabled_keys = positive_balance_keys
-
-    # 基于余额的策略
-    if config.CALL_STRATEGY == "high":
-        return max(enabled_keys, key=lambda x: x[1])[0]
-    elif config.CALL_STRATEGY == "low":
-        return min(enabled_keys, key=lambda x: x[1])[0]
-
-    # 基于使用次数的策略
-    elif config.CALL_STRATEGY == "least_used":
-        cursor.execute(
-            "SELECT key, usage_count FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        usage_data = cursor.fetchall()
-        return min(usage_data, key=lambda x: x[1])[0]
-    elif config.CALL_STRATEGY == "most_used":
-        cursor.execute(
-            "SELECT key, usage_count FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        usage_data = cursor.fetchall()
-        return max(usage_data, key=lambda x: x[1])[0]
-
-    # 基于添加时间的策略
-    elif config.CALL_STRATEGY == "oldest":
-        cursor.execute(
-            "SELECT key, add_time FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        time_data = cursor.fetchall()
-        return min(time_data, key=lambda x: x[1])[0]
-    elif config.CALL_STRATEGY == "newest":
-        cursor.execute(
-            "SELECT key, add_time FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        time_data = cursor.fetchall()
-        return max(time_data, key=lambda x: x[1])[0]
+    # 游标的值直接作为 SQL 参数，只接受 SQLite 能绑定的标量
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            return None
+        if isinstance(value, int) and not -(2**63) <= value < 2**63:
+            return None
+    return values
 
-    # 默认随机策略
-    else:
-        return random.choice(enabled_keys)[0]
+
+def clamp_page_size(page_size: int) -> int:
+    """限制每页条数在合理范围内"""
+    return max(1, min(page_size, config.MAX_PAGE_SIZE))
+
+
+def select_api_key(use_zero_balance=False, accept=None):
+    """根据配置策略从内存密钥池中选择一个API密钥
+
+    Args:
+        use_zero_balance: 是否使用余额为0的密钥
+        accept: 可选的过滤函数，返回 False 的密钥会被跳过
+
+    Returns:
+        选择的API密钥，没有可用密钥时返回None
+    """
+    # 使用余额为0的key时，固定使用随机策略
+    return key_pool.select(config.CALL_STRATEGY, use_zero_balance, accept)
 
 
 async def check_and_remove_key(key: str):
@@ -138,10 +91,15 @@ async def check_and_remove_key(key: str):
     logger = logging.getLogger(__name__)
     if valid:
         logger.info(f"Key validation successful: {key[:8]}*** - Balance: {balance}")
-        # 更新余额
-        cursor.execute("UPDATE api_keys SET balance = ? WHERE key = ?", (balance, key))
-        conn.commit()
+        # 更新余额与核实时间
+        checked_at = time.time()
+        await database.execute(
+            "UPDATE api_keys SET balance = ?, last_checked = ? WHERE key = ?",
+            (balance, checked_at, key),
+        )
+        key_pool.update_balance(key, balance)
+        key_pool.mark_checked(key, checked_at)
     else:
         logger.warning(f"Invalid key detected: {key[:8]}*** - Removing from pool")
-        cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-        conn.commit()
+        await database.execute("DELETE FROM api_keys WHERE key = ?", (key,))
+        key_pool.remove(key)